@@ -0,0 +1,501 @@
+"""MFAC preconditioning for any keras optimizer (F because of factory design pattern)."""
+
+import functools
+from pathlib import Path
+
+import tensorflow as tf
+
+from src.optimizers.InverseHessianApproximator import InverseHessianApproximator
+from src.utils.helper_functions import (
+    FlatView,
+    GradientBlock,
+    ReplicaLocalCheckpoint,
+    group_variables,
+    new_variable,
+)
+
+MFAC_ARGUMENTS = (
+    "m",
+    "damp",
+    "incremental_gram",
+    "refresh_interval",
+    "block_by",
+    "min_block_size",
+    "block_m",
+    "history_dtype",
+    "history_tile_size",
+    "history_path",
+    "history_chunk_rows",
+    "warm_start",
+    "accumulation_steps",
+    "damping_target",
+    "resizable_history",
+    "profile",
+    "sparse_variables",
+)
+
+# phases of an MFAC step whose seconds are accumulated in `phase_seconds` when profiling
+PROFILED_PHASES = ("append", "setup", "product", "apply_gradients")
+
+
+class MfacMixin:
+    """Mixin putting MFAC preconditioning in front of a keras optimizer.
+
+    ``apply_gradients`` scales the gradients with the inverse hessian
+    approximation of their block and hands them to the update rule of the
+    next class in the method resolution order, e.g. ``class
+    Mfac(MfacMixin, tf.keras.optimizers.SGD)``. ``mfac_class`` creates such
+    classes for any optimizer class, ``with_mfac`` for an optimizer instance.
+
+    Variables named in ``sparse_variables``, by default the embeddings of keras
+    Embedding layers, get blocks of their own that are not preconditioned, so
+    their sparse gradients (tf.IndexedSlices) stay sparse up to the update
+    rule. They are known from the variables alone, so the blocks are the same
+    whether ``build`` or the first ``apply_gradients`` creates them.
+
+    Under a tf.distribute strategy with several replicas the gradients are
+    all-reduced once before they enter the fifo-ques, which are sharded along
+    the parameters over the replicas.
+
+    With ``profile`` the seconds every step spends in the phases of
+    ``PROFILED_PHASES`` are added up in the optimizer variable ``phase_seconds``,
+    see ``StepTimeProfiler`` in src.utils.monitor_training.
+    """
+
+    def __init__(
+        self,
+        m,
+        damp,
+        incremental_gram=True,
+        refresh_interval=1,
+        block_by=None,
+        min_block_size=0,
+        block_m=None,
+        history_dtype="float32",
+        history_tile_size=None,
+        history_path=None,
+        history_chunk_rows=32,
+        warm_start=None,
+        accumulation_steps=1,
+        damping_target=None,
+        resizable_history=False,
+        profile=False,
+        sparse_variables=("embeddings",),
+        **kwargs,
+    ):
+        """Initialize the MFAC state, remaining arguments go to the optimizer.
+
+        Args:
+            m: int, number of gradients to store
+            damp: float, damping factor
+            incremental_gram: bool, whether to update the gram matrix of the stored
+                gradients incrementally instead of recomputing it every step
+            refresh_interval: int, number of steps D and B are reused before they are
+                set up again
+            block_by: None to precondition all variables jointly, "layer" or
+                "variable" for a block-diagonal preconditioner with one block per layer
+                or per variable
+            min_block_size: int, blocks with fewer parameters are not preconditioned
+            block_m: dict, number of gradients to store for single blocks by block name
+            history_dtype: string, storage dtype of the stored gradients, one of
+                "float32", "float16", "bfloat16" or "int8"
+            history_tile_size: int, number of parameters per column tile of the products
+                with the stored gradients, None to multiply the whole matrix at once
+            history_path: string, directory for memory-mapped files holding the stored
+                gradients, None to keep them in memory
+            history_chunk_rows: int, number of rows of a memory-mapped history that are
+                read at once
+            warm_start: int, number of stored gradients from which on the partially
+                filled fifo-que is used for preconditioning, None to wait until it is full
+            accumulation_steps: int, number of micro-batches whose gradients are
+                averaged before one fifo-que append and update
+            damping_target: float, target of the mean diagonal of D relative to m,
+                towards which the damping adapts on every setup, None for a fixed damp
+            resizable_history: bool, whether `set_history_size` may change the number
+                of stored gradients at runtime
+            profile: bool, whether to time the phases of every step, the gradients
+                are then scaled without XLA
+            sparse_variables: names of the variables, without their scope, that get
+                sparse gradients and are not preconditioned, by default the embeddings
+                of keras Embedding layers
+            **kwargs: arguments of the optimizer
+        """
+        super().__init__(**kwargs)
+        self.m = m
+        self.damp = damp
+        self.refresh_interval = refresh_interval
+        self.incremental_gram = incremental_gram
+        self.block_by = block_by
+        self.min_block_size = min_block_size
+        self.block_m = block_m
+        self.history_dtype = history_dtype
+        self.history_tile_size = history_tile_size
+        # a string, so the config stays serializable
+        self.history_path = None if history_path is None else str(history_path)
+        self.history_chunk_rows = history_chunk_rows
+        self.warm_start = warm_start
+        self.accumulation_steps = accumulation_steps
+        self.damping_target = damping_target
+        self.resizable_history = resizable_history
+        self.profile = profile
+        self.sparse_variables = tuple(sparse_variables)
+        if history_path is not None:
+            # the memory-mapped history runs host code that xla cannot compile
+            self.jit_compile = False
+        self.blocks = None
+        self.accumulators = None
+        self.phase_seconds = None
+        self.sparse_indices = set()
+        # checkpoints of the replica-local state of fifo-ques sharded over replicas
+        self.replica_local_state = []
+        if refresh_interval < 1:
+            raise ValueError("`refresh_interval` must be at least 1.")
+        if warm_start is not None and warm_start < 1:
+            raise ValueError("`warm_start` must be at least 1.")
+        if accumulation_steps < 1:
+            raise ValueError("`accumulation_steps` must be at least 1.")
+
+    def build(self, var_list):
+        """Initialize optimizer variables.
+
+        Besides the variables of the optimizer the fifo-ques and the matrices D and B
+        of every block are allocated, so no state is created during a training step.
+        With `accumulation_steps` above one every variable gets a gradient accumulator,
+        with `profile` the seconds per phase get a variable.
+
+        Args:
+          var_list: list of model variables to build the optimizer on.
+        """
+        super().build(var_list)
+        if self.blocks is not None:
+            return
+        if self.accumulation_steps > 1:
+            self.accumulators = [
+                self.add_variable_from_reference(model_variable=var, variable_name="accumulator")
+                for var in var_list
+            ]
+            self.micro_step = self.add_variable(shape=(), dtype=tf.int64, name="micro_step")
+        if self.profile:
+            if tf.distribute.get_strategy().num_replicas_in_sync > 1:
+                raise ValueError("`profile` is not supported with several replicas.")
+            self.phase_seconds = self.add_variable(
+                shape=(len(PROFILED_PHASES),), dtype=tf.float64, name="phase_seconds"
+            )
+        self._build_blocks(var_list)
+
+    def apply_gradients(
+        self, grads_and_vars, name=None, skip_gradients_aggregation=False, **kwargs
+    ):
+        """Scale the gradients with the MFAC algorithm and apply them.
+
+        With `accumulation_steps` above one the gradients are only added to the
+        accumulators, and every `accumulation_steps`-th call their mean is scaled
+        and applied, so the fifo-que gets the gradient of the whole effective batch.
+
+        Args:
+            grads_and_vars: list of (gradient, variable) pairs
+            name: string, name scope of the optimizer's apply_gradients
+            skip_gradients_aggregation: bool, whether the gradients are already
+                aggregated over the replicas
+            **kwargs: further keyword arguments of the optimizer's apply_gradients
+
+        Returns:
+            the iterations of the optimizer, i.e. the number of applied updates
+        """
+        grads_and_vars = list(grads_and_vars)
+        aggregate = kwargs.pop("experimental_aggregate_gradients", True)
+        if aggregate and not skip_gradients_aggregation:
+            # every replica has to append the same gradient
+            grads_and_vars = self.aggregate_gradients(grads_and_vars)
+        grads = [grad for grad, _ in grads_and_vars]
+        var_list = [var for _, var in grads_and_vars]
+        with tf.init_scope():
+            # fifo-que and matrices must exist before the gradients are scaled
+            self.build(var_list)
+        if self.accumulation_steps == 1:
+            return self._apply_scaled_grads(grads, var_list, name, **kwargs)
+        if tf.distribute.get_strategy().num_replicas_in_sync > 1:
+            # the update would run collectives inside tf.cond
+            raise ValueError("`accumulation_steps` is not supported with several replicas.")
+        for accumulator, grad in zip(self.accumulators, grads):
+            if isinstance(grad, tf.IndexedSlices):
+                accumulator.scatter_add(grad)
+            else:
+                accumulator.assign_add(grad)
+        micro_step = self.micro_step.assign_add(1)
+
+        def apply_accumulated():
+            mean_grads = [
+                accumulator / self.accumulation_steps for accumulator in self.accumulators
+            ]
+            with tf.control_dependencies(
+                [self._apply_scaled_grads(mean_grads, var_list, name, **kwargs)]
+            ):
+                for accumulator in self.accumulators:
+                    accumulator.assign(tf.zeros_like(accumulator))
+                return tf.identity(self.iterations)
+
+        return tf.cond(
+            micro_step % self.accumulation_steps == 0,
+            apply_accumulated,
+            lambda: tf.identity(self.iterations),
+        )
+
+    def _apply_scaled_grads(self, grads, var_list, name=None, **kwargs):
+        """Scale aggregated gradients and hand them to the optimizer's update rule."""
+        scaled_grads = self.scale_grads(grads)
+        return self._timed(
+            "apply_gradients",
+            functools.partial(super().apply_gradients, skip_gradients_aggregation=True),
+            zip(scaled_grads, var_list),
+            name=name,
+            **kwargs,
+        )
+
+    def _timed(self, phase, fn, *args, **kwargs):
+        """Call fn and add its seconds to the phase's entry of `phase_seconds` if profiling.
+
+        Args:
+            phase: string, one of PROFILED_PHASES
+            fn: function to time
+            *args: positional arguments of fn
+            **kwargs: keyword arguments of fn
+
+        Returns:
+            the result of fn
+        """
+        if not self.profile:
+            return fn(*args, **kwargs)
+        start = tf.timestamp()
+        graph = tf.compat.v1.get_default_graph()
+        num_ops = len(graph.get_operations())
+        with tf.control_dependencies([start]):
+            result = fn(*args, **kwargs)
+        # timestamps are not ordered with the ops of fn by the automatic control
+        # dependencies, the end waits for every op fn added, none when eager
+        with tf.control_dependencies(graph.get_operations()[num_ops:]):
+            seconds = tf.timestamp() - start
+        self.phase_seconds.assign_add(
+            tf.one_hot(PROFILED_PHASES.index(phase), len(PROFILED_PHASES), dtype=tf.float64)
+            * seconds
+        )
+        return result
+
+    def scale_grads(self, grads):
+        """Scales the Gradients using the MFAC algorithm.
+
+        The Gradients of every block are formatted into one singe one-dimensional Tensor
+        and appended to the block's fifo-que. If the fifo-que is full, the algorithm computes
+        the scaled gradients with the MFAC algorithm. Gradients of blocks that are not
+        preconditioned are returned as they are.
+
+        Args:
+            grads: list of gradients for each variable
+
+        Returns:
+            list of scaled gradients in the original shape
+
+        """
+        # collectives of sharded fifo-ques may not run in a nested tf.function,
+        # xla cannot compile the timestamps of a profile
+        if (
+            self.jit_compile
+            and not self.profile
+            and tf.distribute.get_strategy().num_replicas_in_sync == 1
+        ):
+            return self._scale_grads_xla(list(grads))
+        return self._scale_grads(list(grads))
+
+    def set_history_size(self, size: int):
+        """Store at most `size` gradients per block from now on.
+
+        Blocks keep their newest gradients and set up D and B for them right away.
+        Blocks that preconditioned before keep doing so with these gradients while
+        a grown history refills. Blocks with fewer than `size` slots keep all of them.
+
+        Args:
+            size: int, number of gradients to store, between 1 and m
+        """
+        if not self.resizable_history:
+            raise ValueError("The optimizer was not created with `resizable_history`.")
+
+        def resize():
+            for block in self.blocks:
+                if block.m is not None:
+                    block.hessian.resize(min(size, block.m))
+
+        # the strategy the optimizer was created in, callbacks run outside its scope
+        strategy = self._distribution_strategy
+        if strategy.num_replicas_in_sync > 1:
+            # every replica moves its own shard of the fifo-ques
+            strategy.run(tf.function(resize))
+        else:
+            resize()
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({name: getattr(self, name) for name in MFAC_ARGUMENTS})
+        return config
+
+    def _build_blocks(self, var_list):
+        """Group the variables into blocks and allocate the state of each block.
+
+        Every preconditioned block gets its own InverseHessianApproximator, whose
+        variables are registered as optimizer variables. Variables named in
+        `sparse_variables` get unpreconditioned blocks of their own.
+
+        Args:
+            var_list: list of model variables.
+        """
+        self.blocks = []
+        num_replicas = tf.distribute.get_strategy().num_replicas_in_sync
+        self.sparse_indices = {
+            idx
+            for idx, var in enumerate(var_list)
+            if var.name.split(":")[0].split("/")[-1] in self.sparse_variables
+        }
+        for idx in sorted(self.sparse_indices):
+            view = FlatView([var_list[idx].shape])
+            self.blocks.append(GradientBlock(var_list[idx].name.split(":")[0], [idx], view))
+        for name, indices in group_variables(var_list, self.block_by).items():
+            indices = [idx for idx in indices if idx not in self.sparse_indices]
+            if not indices:
+                continue
+            view = FlatView([var_list[idx].shape for idx in indices])
+            m = self.block_m.get(name, self.m) if self.block_m else self.m
+            if view.size < self.min_block_size:
+                m = None
+            block = GradientBlock(name, indices, view, m)
+            if block.m is not None:
+                history_file = None
+                if self.history_path is not None:
+                    history_file = Path(
+                        self.history_path, f"{self.name}_{name}.dat".replace("/", "_")
+                    )
+                block.hessian = InverseHessianApproximator(
+                    block.m,
+                    self.damp,
+                    refresh_interval=self.refresh_interval,
+                    warm_start=self.warm_start,
+                    incremental_gram=self.incremental_gram,
+                    history_dtype=self.history_dtype,
+                    history_tile_size=self.history_tile_size,
+                    history_file=history_file,
+                    history_chunk_rows=self.history_chunk_rows,
+                    jit_compile=self.jit_compile,
+                    num_replicas=num_replicas,
+                    damping_target=self.damping_target,
+                    resizable=self.resizable_history,
+                    name=name,
+                )
+                block.hessian.build(view.size, add_variable=self._add_block_variable)
+            self.blocks.append(block)
+
+    def _add_block_variable(self, shape, dtype, initializer="zeros", name=None):
+        """Create a variable of an InverseHessianApproximator, checkpointed with the optimizer.
+
+        With several replicas the approximator creates replica-local variables,
+        whose replicas hold different shards. They are tracked with a checkpoint
+        of every replica's copy instead of as optimizer variables.
+        """
+        if tf.distribute.get_strategy().num_replicas_in_sync == 1:
+            return self.add_variable(shape=shape, dtype=dtype, initializer=initializer, name=name)
+        variable = new_variable(shape, dtype=dtype, initializer=initializer, name=name)
+        self.replica_local_state.append(ReplicaLocalCheckpoint(variable))
+        return variable
+
+    def _scale_grads(self, grads):
+        """Scale the gradients of every preconditioned block with the MFAC algorithm.
+
+        Args:
+            grads: list of gradients for each variable
+
+        Returns:
+            list of scaled gradients in the original shape
+        """
+        scaled_grads = list(grads)
+        for block in self.blocks:
+            if block.m is None:
+                continue
+            flat_grad = block.view.flatten([grads[idx] for idx in block.indices])
+            flat_grad = self._scale_flat_grad(block, flat_grad)
+            for idx, grad in zip(block.indices, block.view.unflatten(flat_grad)):
+                scaled_grads[idx] = grad
+        return scaled_grads
+
+    @tf.function(jit_compile=True)
+    def _scale_grads_xla(self, grads):
+        return self._scale_grads(grads)
+
+    def _scale_flat_grad(self, block, gradient):
+        """Append the flat gradient to the fifo-que and scale it once enough are stored.
+
+        Args:
+            block: GradientBlock the gradient belongs to
+            gradient: one-dimensional gradient of all variables of the block
+
+        Returns:
+            scaled gradient if the fifo-que holds `warm_start` gradients (all m by
+            default), else the gradient itself
+        """
+        self._timed("append", block.hessian.append, gradient)
+        self._timed("setup", block.hessian.refresh)
+        return self._timed("product", block.hessian.apply, gradient)
+
+    def inverse_hessian_product(self, vectors):
+        """Apply the current preconditioner to a batch of vectors.
+
+        Nothing is appended to the fifo-ques and D and B are not set up again.
+        Blocks that are not preconditioned (yet) return their part unchanged.
+
+        Args:
+            vectors: list with one tensor per model variable of shape
+                [k] + variable shape
+
+        Returns:
+            list of preconditioned tensors of the same shapes
+        """
+        scaled = list(vectors)
+        for block in self.blocks:
+            if block.m is None:
+                continue
+            flat = block.view.flatten_batch([vectors[idx] for idx in block.indices])
+            flat = block.hessian.apply_batch(flat)
+            for idx, tensor in zip(block.indices, block.view.unflatten_batch(flat)):
+                scaled[idx] = tensor
+        return scaled
+
+
+_MFAC_CLASSES: dict = {}
+
+
+def mfac_class(base_class):
+    """Return the subclass of a keras optimizer class with MFAC preconditioning.
+
+    Args:
+        base_class: subclass of tf.keras.optimizers.Optimizer, e.g.
+            tf.keras.optimizers.RMSprop
+
+    Returns:
+        class taking the MFAC arguments of MfacMixin and those of base_class.
+    """
+    if base_class not in _MFAC_CLASSES:
+        _MFAC_CLASSES[base_class] = type(f"Mfac{base_class.__name__}", (MfacMixin, base_class), {})
+    return _MFAC_CLASSES[base_class]
+
+
+def with_mfac(optimizer, m, damp, **kwargs):
+    """Create an optimizer like the given one that preconditions with MFAC.
+
+    Args:
+        optimizer: unbuilt keras optimizer, its config is copied
+        m: int, number of gradients to store
+        damp: float, damping factor
+        **kwargs: further MFAC arguments, see MfacMixin
+
+    Returns:
+        instance of mfac_class(type(optimizer)).
+    """
+    config = optimizer.get_config()
+    config.update(kwargs, m=m, damp=damp)
+    return mfac_class(type(optimizer)).from_config(config)
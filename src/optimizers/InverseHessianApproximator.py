@@ -0,0 +1,421 @@
+"""Class for the M-FAC approximation of inverse hessian vector products."""
+
+import contextlib
+
+import tensorflow as tf
+
+from src.utils.helper_functions import (
+    MemmapMatrixFifo,
+    ReplicaShardedMatrixFifo,
+    RowWiseMatrixFifo,
+    new_variable,
+    replica_local_variables,
+)
+
+scalmul = tf.math.scalar_mul
+matvec = tf.linalg.matvec
+diag_part = tf.linalg.diag_part
+
+
+class InverseHessianApproximator:
+    """Inverse of the damped empirical fisher of the last m gradients.
+
+    The hessian is approximated by 1 / damp * I + 1 / m * sum_i g_i g_i^T over
+    the gradients g_i in a fifo-que. ``update`` appends a gradient and sets up
+    the matrices D and B of Algorithm 1 when they are due, ``apply`` and
+    ``apply_batch`` multiply one or k vectors with the inverse by Algorithm 2.
+
+    The approximator does not depend on a training step, so it can be used on
+    its own, e.g. for many inverse hessian products when pruning. The M-FAC
+    optimizers keep one per block of variables and create all of its state,
+    fifo-que included, as optimizer variables, so a checkpoint of the
+    optimizer restores the stored gradients and the factorization.
+
+    With ``num_replicas`` above one the approximator runs in replica context of
+    a tf.distribute strategy. Every replica gets the same, already all-reduced
+    gradients, stores its column shard of the fifo-que and keeps its own copy
+    of D and B.
+
+    With ``damping_target`` the damping adapts on every setup of D and B, see
+    ``_adapt_damping``. ``resize`` changes the number of stored gradients at
+    runtime if the approximator is ``resizable``.
+    """
+
+    def __init__(
+        self,
+        m,
+        damp,
+        refresh_interval=1,
+        warm_start=None,
+        incremental_gram=True,
+        history_dtype="float32",
+        history_tile_size=None,
+        history_file=None,
+        history_chunk_rows=32,
+        jit_compile=False,
+        num_replicas=1,
+        damping_target=None,
+        resizable=False,
+        name="inverse_hessian",
+    ):
+        """Initialize the approximator, its state is allocated in `build`.
+
+        Args:
+            m: int, number of gradients to store
+            damp: float, damping factor
+            refresh_interval: int, number of updates D and B are reused before they
+                are set up again
+            warm_start: int, number of stored gradients from which on the partially
+                filled fifo-que is used, None to wait until it is full
+            incremental_gram: bool, whether to update the gram matrix of the stored
+                gradients incrementally instead of recomputing it on every setup
+            history_dtype: string, storage dtype of the stored gradients, one of
+                "float32", "float16", "bfloat16" or "int8"
+            history_tile_size: int, number of parameters per column tile of the products
+                with the stored gradients, None to multiply the whole matrix at once
+            history_file: string, memory-mapped file holding the stored gradients,
+                None to keep them in memory
+            history_chunk_rows: int, number of rows of a memory-mapped history that are
+                read at once
+            jit_compile: bool, whether the products run in XLA compiled functions,
+                which need static shapes
+            num_replicas: int, number of replicas the fifo-que is sharded over
+            damping_target: float, target of the mean diagonal of D relative to the
+                number of stored gradients, towards which the damping is adapted, None
+                for a fixed damping
+            resizable: bool, whether `resize` may change the history size at runtime
+            name: string, prefix of the variable names
+        """
+        if refresh_interval < 1:
+            raise ValueError("`refresh_interval` must be at least 1.")
+        if warm_start is not None and warm_start < 1:
+            raise ValueError("`warm_start` must be at least 1.")
+        if num_replicas > 1 and history_file is not None:
+            raise ValueError("A memory-mapped history cannot be sharded over replicas.")
+        if damping_target is not None and damping_target <= 0:
+            raise ValueError("`damping_target` must be positive.")
+        self.m = m
+        self.damp = damp
+        self.refresh_interval = refresh_interval
+        self.warm_start = warm_start
+        self.incremental_gram = incremental_gram
+        self.history_dtype = history_dtype
+        self.history_tile_size = history_tile_size
+        self.history_file = history_file
+        self.history_chunk_rows = history_chunk_rows
+        self.jit_compile = jit_compile
+        self.num_replicas = num_replicas
+        self.damping_target = damping_target
+        self.resizable = resizable
+        self.name = name
+        self.GradFifo = None
+        self.D = None
+        self.B = None
+        self.slot_order = None
+        self.staleness = None
+        self.history_size = None
+        self.damping = None
+        self.kept_rows = None
+
+    def build(self, size: int, add_variable=None):
+        """Allocate the fifo-que, D, B and their bookkeeping.
+
+        Does nothing if the approximator is already built.
+
+        Args:
+            size: int, length of the gradients
+            add_variable: function with arguments shape, dtype, initializer and name
+                creating a variable, e.g. `Optimizer.add_variable`. Plain variables by
+                default.
+        """
+        if self.GradFifo is not None:
+            return
+        add_variable = add_variable or new_variable
+        if self.num_replicas > 1:
+            self.GradFifo = ReplicaShardedMatrixFifo(
+                self.m,
+                self.num_replicas,
+                dtype=self.history_dtype,
+                tile_size=self.history_tile_size,
+            )
+        elif self.history_file is None:
+            self.GradFifo = RowWiseMatrixFifo(
+                self.m,
+                circular=True,
+                track_gram=self.incremental_gram,
+                dtype=self.history_dtype,
+                tile_size=self.history_tile_size,
+            )
+        else:
+            self.GradFifo = MemmapMatrixFifo(
+                self.m,
+                self.history_file,
+                track_gram=self.incremental_gram,
+                dtype=self.history_dtype,
+                chunk_rows=self.history_chunk_rows,
+            )
+        local = replica_local_variables() if self.num_replicas > 1 else contextlib.nullcontext()
+        with local:
+
+            def add_fifo_variable(shape, dtype, name, **kwargs):
+                return add_variable(shape=shape, dtype=dtype, name=f"{self.name}/{name}", **kwargs)
+
+            self.GradFifo.build(size, add_fifo_variable)
+            self.D = add_variable(shape=(self.m, self.m), dtype=tf.float32, name=f"{self.name}/D")
+            self.B = add_variable(shape=(self.m, self.m), dtype=tf.float32, name=f"{self.name}/B")
+            self.slot_order = add_variable(
+                shape=(self.m,), dtype=tf.int32, name=f"{self.name}/slot_order"
+            )
+            self.staleness = add_variable(shape=(), dtype=tf.int64, name=f"{self.name}/staleness")
+            self.history_size = add_variable(
+                shape=(), dtype=tf.float32, name=f"{self.name}/history_size"
+            )
+            self.damping = add_variable(
+                shape=(),
+                dtype=tf.float32,
+                initializer=tf.keras.initializers.Constant(self.damp),
+                name=f"{self.name}/damping",
+            )
+            if self.resizable:
+                self.kept_rows = add_variable(
+                    shape=(), dtype=tf.int64, name=f"{self.name}/kept_rows"
+                )
+
+    @property
+    def warm_start_size(self) -> tf.Tensor:
+        """Number of stored gradients from which on vectors are preconditioned.
+
+        That is `warm_start`, by default the capacity of the fifo-que, i.e. m
+        unless it was resized.
+        """
+        capacity = tf.cast(self.GradFifo.capacity, tf.int64)
+        if self.warm_start is None:
+            return capacity
+        return tf.minimum(tf.constant(self.warm_start, tf.int64), capacity)
+
+    @property
+    def ready(self) -> tf.Tensor:
+        """Whether D and B are set up, i.e. the fifo-que holds enough gradients.
+
+        After a resize of a ready approximator the gradients it kept are enough,
+        so a grown fifo-que stays in use while it refills.
+        """
+        ready = self.GradFifo.counter >= self.warm_start_size
+        if self.kept_rows is None:
+            return ready
+        return tf.logical_or(
+            ready, tf.logical_and(self.kept_rows > 0, self.GradFifo.counter >= self.kept_rows)
+        )
+
+    def update(self, gradient: tf.Tensor):
+        """Append a gradient to the fifo-que and set up D and B when they are due.
+
+        D and B are set up when the fifo-que first holds `warm_start` gradients and
+        then every `refresh_interval` updates. In between the last factorization is
+        reused and `staleness` counts the updates since it was computed.
+
+        Args:
+            gradient: one-dimensional gradient, builds the approximator if needed
+        """
+        self.append(gradient)
+        self.refresh()
+
+    def append(self, gradient: tf.Tensor):
+        """Append a gradient to the fifo-que, the first half of `update`.
+
+        Args:
+            gradient: one-dimensional gradient, builds the approximator if needed
+        """
+        if self.GradFifo is None:
+            self.build(gradient.shape[0])
+        self.GradFifo.append(gradient)
+
+    def refresh(self):
+        """Set up D and B if they are due after an append, the second half of `update`."""
+        ready = self.ready
+        refresh = tf.logical_and(
+            ready,
+            tf.logical_or(
+                tf.logical_or(
+                    self.GradFifo.counter == self.warm_start_size,
+                    self.staleness + 1 >= self.refresh_interval,
+                ),
+                # e.g. a memory-mapped history that was written after a checkpoint
+                self.GradFifo.rows_lost(),
+            ),
+        )
+        staleness = tf.cond(
+            refresh,
+            self._refreshMatrices,
+            lambda: self.staleness + tf.cast(ready, tf.int64),
+        )
+        self.staleness.assign(staleness)
+
+    def apply(self, vec: tf.Tensor) -> tf.Tensor:
+        """Multiply a vector with the inverse hessian.
+
+        Args:
+            vec: one-dimensional tensor of the gradient length
+
+        Returns:
+            the product, or vec itself while the fifo-que holds too few gradients
+        """
+        return self._if_ready(self._compute_InvMatVec, vec)
+
+    def apply_batch(self, mat: tf.Tensor) -> tf.Tensor:
+        """Multiply k vectors with the inverse hessian at once.
+
+        Args:
+            mat: tensor of k by gradient length, one vector per row
+
+        Returns:
+            the products row by row, or mat itself while the fifo-que holds too few
+            gradients
+        """
+        return self._if_ready(self._compute_InvMatMul, mat)
+
+    def _if_ready(self, product, value: tf.Tensor) -> tf.Tensor:
+        """Return product(value) once D and B are set up, else value."""
+        if self.num_replicas > 1:
+            # the product runs collectives, which may not be inside a tf.cond
+            return tf.where(self.ready, product(value), value)
+        return tf.cond(self.ready, lambda: product(value), lambda: tf.identity(value))
+
+    def reset(self):
+        """Forget all stored gradients."""
+        self.GradFifo.reset()
+        self.staleness.assign(0)
+        if self.kept_rows is not None:
+            self.kept_rows.assign(0)
+
+    def resize(self, size):
+        """Store at most `size` gradients from now on.
+
+        The newest gradients are kept and D and B are set up for them right away.
+        If the approximator was ready, the kept gradients are used from now on,
+        like a partially filled fifo-que with `warm_start`, also when the history
+        grows and refills. Under a tf.distribute strategy call it in replica context.
+
+        Args:
+            size: int, number of gradients to store, between 1 and m
+        """
+        if not self.resizable:
+            raise ValueError("The approximator was not created `resizable`.")
+        if not 1 <= size <= self.m:
+            raise ValueError(f"`size` must be between 1 and {self.m}.")
+        ready = self.ready
+        self.GradFifo.resize(size)
+        self.kept_rows.assign(tf.where(ready, self.GradFifo.counter, 0))
+        staleness = tf.cond(self.ready, self._refreshMatrices, lambda: self.staleness.value())
+        self.staleness.assign(staleness)
+
+    def _history_rows(self):
+        """Return the number of leading fifo slots that hold gradients.
+
+        Before the circular fifo-que is full, or after it was resized, its gradients
+        are in the first slots, so the products skip the empty ones. XLA needs static
+        shapes, there the empty rows are multiplied as zeros.
+
+        Returns:
+            int32 scalar tensor or None for all slots
+        """
+        if (self.warm_start is None and not self.resizable) or self.jit_compile:
+            return None
+        return tf.cast(self._stored(), tf.int32)
+
+    def _stored(self) -> tf.Tensor:
+        """Return the number of stored gradients as int64 tensor."""
+        return tf.minimum(self.GradFifo.counter, tf.cast(self.GradFifo.capacity, tf.int64))
+
+    def _adapt_damping(self):
+        """Move the damping towards `damping_target` before D and B are set up.
+
+        The diagonal of D over the number of stored gradients k measures the
+        curvature the gradients add relative to the damping and grows with the
+        damping. From the last setup the damping is scaled by the ratio of
+        `damping_target` to that measure, limited to a factor of two per setup.
+        """
+        measure = tf.math.divide_no_nan(
+            tf.reduce_sum(diag_part(self.D)), tf.square(self.history_size)
+        )
+        factor = tf.clip_by_value(tf.math.divide_no_nan(self.damping_target, measure), 0.5, 2.0)
+        # no D before the first setup
+        factor = tf.where(measure > 0, factor, 1.0)
+        self.damping.assign(self.damping * factor)
+
+    def _refreshMatrices(self):
+        self._setupMatrices()
+        return tf.zeros([], dtype=tf.int64)
+
+    def _setupMatrices(self):
+        """Implements Algorithm1 from paper.
+
+        Here the matrices B and D are set up and calculated according
+        to Algorithm 1 so that they can be used for the function _compute_InvMatVec.
+        The recursion of Algorithm 1 is a Gaussian elimination of m * I + D, so both
+        matrices are read off one Cholesky factorization instead of m sliced updates.
+        While the fifo-que fills up, m is the number of stored gradients. The empty
+        slots have zero Gram entries and decouple from the factorization.
+        """
+        if self.damping_target is not None:
+            self._adapt_damping()
+        damp = self.damping
+        m = self.history_size.assign(tf.cast(self._stored(), tf.float32))
+        # fifo is a ring buffer, bring rows and columns into logical order.
+        # The order is kept so a reused factorization still maps to its slots.
+        order = self.slot_order.assign(self.GradFifo.order())
+        gram = self.GradFifo.gram_matrix(self._history_rows())
+        gram = tf.gather(tf.gather(gram, order), order, axis=1)
+        eye = tf.eye(self.m, self.m)
+        chol = tf.linalg.cholesky(m * eye + scalmul(damp, gram))
+        pivots = diag_part(chol)
+        # row i of the eliminated upper triangle is chol[:, i] * chol[i, i]
+        self.D.assign(tf.transpose(chol * pivots) - m * eye)
+        # B = damp * L^-1 with unit lower triangular L = chol * diag(1 / pivots)
+        chol_inv = tf.linalg.triangular_solve(chol, eye, lower=True)
+        self.B.assign(scalmul(damp, tf.expand_dims(pivots, axis=1) * chol_inv))
+
+    def _compute_InvMatVec(self, vec: tf.Tensor):
+        """Implements Algorithm2 from paper.
+
+        Compute the Matrix vector product using precomputed matrices D and B.
+        The forward substitution over q is the product with B / damp.
+
+        Args:
+            vec: tf.Tensor
+
+        Returns:
+            scaled gradient vector
+        """
+        order = self.slot_order
+        nrows = self._history_rows()
+        q_vec = tf.gather(self.GradFifo.matvec(vec, nrows), order)
+        # no nan while nothing is set up and the product is discarded
+        q_vec = tf.math.divide_no_nan(matvec(self.B, q_vec), self.history_size + diag_part(self.D))
+        coef = matvec(self.B, q_vec, transpose_a=True)
+        # back to slot order so the history is multiplied in place, argsort inverts
+        # the permutation and also accepts the zeros before the first setup
+        coef = tf.gather(coef, tf.argsort(order))
+        result = scalmul(self.damping, vec) - self.GradFifo.rmatvec(coef, nrows)
+        return result
+
+    def _compute_InvMatMul(self, mat: tf.Tensor):
+        """Algorithm 2 for k vectors at once.
+
+        The products with the fifo-que and with B are matrix products over all
+        vectors instead of k matrix-vector products.
+
+        Args:
+            mat: tf.Tensor of k by gradient length, one vector per row
+
+        Returns:
+            matrix of the scaled vectors
+        """
+        order = self.slot_order
+        nrows = self._history_rows()
+        q_mat = tf.gather(self.GradFifo.matmul(mat, nrows), order, axis=1)
+        q_mat = tf.linalg.matmul(q_mat, self.B, transpose_b=True)
+        q_mat = tf.math.divide_no_nan(q_mat, self.history_size + diag_part(self.D))
+        coefs = tf.linalg.matmul(q_mat, self.B)
+        coefs = tf.gather(coefs, tf.argsort(order), axis=1)
+        return scalmul(self.damping, mat) - self.GradFifo.rmatmul(coefs, nrows)
@@ -2,16 +2,10 @@
 
 import tensorflow as tf
 
-from src.utils.helper_functions import RowWiseMatrixFifo, deflatten
+from src.optimizers.F_MFAC import MfacMixin
 
-matmul = tf.linalg.matmul
-scalmul = tf.math.scalar_mul
-matvec = tf.linalg.matvec
-band_part = tf.linalg.band_part
-diag_part = tf.linalg.diag_part
 
-
-class MFAC(tf.keras.optimizers.Optimizer):
+class MFAC(MfacMixin, tf.keras.optimizers.Optimizer):
     def __init__(
         self,
         learning_rate=0.01,
@@ -24,6 +18,21 @@ class MFAC(tf.keras.optimizers.Optimizer):
         use_ema=False,
         m=512,
         damp=1e-8,
+        incremental_gram=True,
+        refresh_interval=1,
+        block_by=None,
+        min_block_size=0,
+        block_m=None,
+        history_dtype="float32",
+        history_tile_size=None,
+        history_path=None,
+        history_chunk_rows=32,
+        warm_start=None,
+        accumulation_steps=1,
+        damping_target=None,
+        resizable_history=False,
+        profile=False,
+        sparse_variables=("embeddings",),
         ema_momentum=0.99,
         ema_overwrite_frequency=None,
         jit_compile=True,
@@ -43,6 +52,36 @@ class MFAC(tf.keras.optimizers.Optimizer):
             use_ema: bool, whether to use exponential moving average
             m: int, number of gradients to store
             damp: float, damping factor
+            incremental_gram: bool, whether to update the gram matrix of the stored
+                gradients incrementally instead of recomputing it every step
+            refresh_interval: int, number of steps D and B are reused before they are
+                set up again
+            block_by: None to precondition all variables jointly, "layer" or
+                "variable" for a block-diagonal preconditioner with one block per layer
+                or per variable
+            min_block_size: int, blocks with fewer parameters are not preconditioned
+            block_m: dict, number of gradients to store for single blocks by block name
+            history_dtype: string, storage dtype of the stored gradients, one of
+                "float32", "float16", "bfloat16" or "int8"
+            history_tile_size: int, number of parameters per column tile of the products
+                with the stored gradients, None to multiply the whole matrix at once
+            history_path: string, directory for memory-mapped files holding the stored
+                gradients, None to keep them in memory
+            history_chunk_rows: int, number of rows of a memory-mapped history that are
+                read at once
+            warm_start: int, number of stored gradients from which on the partially
+                filled fifo-que is used for preconditioning, None to wait until it is full
+            accumulation_steps: int, number of micro-batches whose gradients are
+                averaged before one fifo-que append and update
+            damping_target: float, target of the mean diagonal of D relative to m,
+                towards which the damping adapts on every setup, None for a fixed damp
+            resizable_history: bool, whether `set_history_size` may change the number
+                of stored gradients at runtime
+            profile: bool, whether to time the phases of every step, the gradients
+                are then scaled without XLA
+            sparse_variables: names of the variables, without their scope, that get
+                sparse gradients and are not preconditioned, by default the embeddings
+                of keras Embedding layers
             ema_momentum: float or ema momentum schedule function
             ema_overwrite_frequency: int or ema overwrite frequency schedule function
             jit_compile: bool, whether to jit compile the optimizer
@@ -53,6 +92,23 @@ class MFAC(tf.keras.optimizers.Optimizer):
 
         """
         super().__init__(
+            m,
+            damp,
+            incremental_gram=incremental_gram,
+            refresh_interval=refresh_interval,
+            block_by=block_by,
+            min_block_size=min_block_size,
+            block_m=block_m,
+            history_dtype=history_dtype,
+            history_tile_size=history_tile_size,
+            history_path=history_path,
+            history_chunk_rows=history_chunk_rows,
+            warm_start=warm_start,
+            accumulation_steps=accumulation_steps,
+            damping_target=damping_target,
+            resizable_history=resizable_history,
+            profile=profile,
+            sparse_variables=sparse_variables,
             name=name,
             weight_decay=weight_decay,
             clipnorm=clipnorm,
@@ -67,11 +123,6 @@ class MFAC(tf.keras.optimizers.Optimizer):
         self._learning_rate = self._build_learning_rate(learning_rate)
         self.momentum = momentum
         self.nesterov = nesterov
-        self.damp = damp
-        self.m = m
-        self.GradFifo = RowWiseMatrixFifo(self.m)
-        self.D = None
-        self.B = None
         self.G = None
         self.lambd = 1 / damp
         if isinstance(momentum, (int, float)) and (momentum < 0 or momentum > 1):
@@ -81,7 +132,8 @@ class MFAC(tf.keras.optimizers.Optimizer):
         """Initialize optimizer variables.
 
         SGD optimizer has one variable `momentums`, only set if `self.momentum`
-        is not 0.
+        is not 0. The fifo-ques and the matrices D and B of every block are allocated
+        here as well, so no state is created during a training step.
 
         Args:
           var_list: list of model variables to build SGD variables on.
@@ -96,30 +148,6 @@ class MFAC(tf.keras.optimizers.Optimizer):
             )
         self._built = True
 
-    def minimize(self, loss, var_list, tape=None):
-        """Minimize the loss function.
-
-        Compute the Gradients for each variable in var_list. If the Fifo-Que is full,
-        the gradients are scaled using the MFAC algorithm and be applied to the variables.
-
-        Args:
-            loss: loss function
-            var_list: list of variables to compute gradients for
-            tape: gradient tape for automatic differentiation
-
-        Returns:
-            None
-
-        """
-        grads_and_vars = self.compute_gradients(loss, var_list, tape)
-
-        if grads_and_vars is not None:
-            grads, vars = zip(*grads_and_vars)
-            reconstructed_tensors = self.scale_grads(grads)
-            grads_and_vars = list(zip(reconstructed_tensors, vars))
-
-        self.apply_gradients(grads_and_vars)
-
     def update_step(self, gradient, variable):
         """Update step given gradient and the associated model variable.
 
@@ -135,8 +163,10 @@ class MFAC(tf.keras.optimizers.Optimizer):
         var_key = self._var_key(variable)
         momentum = tf.cast(self.momentum, variable.dtype)
         m = self.momentums[self._index_dict[var_key]]
+        if isinstance(self.momentum, (int, float)) and self.momentum == 0:
+            # the decay of the momentum is dense, without it sparse updates stay sparse
+            m = None
 
-        # TODO(b/204321487): Add nesterov acceleration.
         if isinstance(gradient, tf.IndexedSlices):
             # Sparse gradients.
             add_value = tf.IndexedSlices(-gradient.values * lr, gradient.indices)
@@ -161,57 +191,6 @@ class MFAC(tf.keras.optimizers.Optimizer):
             else:
                 variable.assign_add(-gradient * lr)
 
-    def scale_grads(self, grads):
-        """Scales the Gradients using the MFAC algorithm.
-
-        This Function formats all the Gradients into one singe one-dimensional Tensor and
-        append it to the fifo-que. If the fifo-que is full, the algorithm computes the scaled
-        gradients with the MFAC algorithm and returns the scaled gradients in the original shape.
-
-
-        Args:
-            grads: list of gradients for each variable
-
-        Returns:
-            list of scaled gradients in the original shape
-
-        """
-        # Array zum speichern der alten shapes
-        original_shapes = []
-        # Array für eindimensionalen Gradienten
-        gradient = []
-        for grad in grads:
-            original_shapes.append(grad.shape)
-            gr = tf.reshape(grad, [-1])
-            gradient.append(gr)
-
-        gradient = tf.concat(gradient, axis=0)
-
-        # Gradienten skalieren
-        self.GradFifo.append(gradient)
-        if self.GradFifo.counter >= self.m:
-            self._setupMatrices()
-            gradient = self._compute_InvMatVec(vec=gradient)
-
-        # Array für Rückformattierung
-        reconstructed_tensors = []
-
-        start_index = 0
-
-        for shape in original_shapes:
-            # Berechnen der Anzahl der Elemente in der ursprünglichen Shape
-            num_elements = tf.reduce_prod(shape)
-            # Extrahieren des entsprechenden Teils des Arrays
-            sub_array = gradient[start_index : start_index + num_elements]
-            # Umformen des Teil-Arrays in die ursprüngliche Shape
-            reconstructed = tf.reshape(sub_array, shape)
-            # Hinzufügen des rekonstruierten Tensors zur Liste
-            reconstructed_tensors.append(reconstructed)
-            # Aktualisieren des Startindex für den nächsten Tensor
-            start_index += num_elements
-
-        return reconstructed_tensors
-
     def get_config(self):
         config = super().get_config()
 
@@ -223,56 +202,3 @@ class MFAC(tf.keras.optimizers.Optimizer):
             }
         )
         return config
-
-    def _setupMatrices(self):
-        """Implements Algorithm1 from paper.
-        
-        Here the matrices B and D are set up and calculated according 
-        to Algorithm 1 so that they can be used for the function _compute_InvMatVec.
-        
-        """
-        self.D = matmul(self.GradFifo.values, self.GradFifo.values, transpose_b=True)
-        self.D = tf.Variable(scalmul(self.damp, self.D))
-        self.B = tf.eye(self.m, self.m)
-        self.B = tf.Variable(scalmul(self.damp, self.B))
-
-        for idx in range(1, self.m):
-            to_subtract = matmul(self.D[idx - 1 :, idx:], self.D[idx - 1 :, idx:], transpose_a=True)
-            to_subtract = scalmul(1 / (self.m + self.D[idx - 1, idx - 1]), to_subtract)
-            self.D[idx:, idx:].assign(self.D[idx:, idx:] - to_subtract)
-
-        # 0 for upper and -1 for all elements
-        self.D.assign(band_part(self.D, 0, -1))
-
-        for idx in range(1, self.m):
-            to_multiply = self.D[:idx, idx] / (-self.m + diag_part(self.D)[:idx])  # noqa E501
-            to_multiply = tf.expand_dims(to_multiply, axis=1)
-            to_assign = matmul(to_multiply, self.B[:idx, :idx], transpose_a=True)
-            self.B[idx, :idx].assign(to_assign)
-
-    def _compute_InvMatVec(self, vec: tf.Tensor):
-        """Implements Algorithm2 from paper.
-
-        Compute the Matrix vector product using precomputed matrices D and B.
-
-        Args:
-            vec: tf.Tensor
-
-        Returns:
-            scaled gradient vector
-        """
-        q_vec = matvec(self.GradFifo.values, vec)
-        q_vec = tf.Variable(scalmul(self.damp, q_vec))
-        q_vec[0].assign(q_vec[0] / (self.m + self.D[0, 0]))
-
-        for idx in range(1, self.m):
-            to_subtract = scalmul(q_vec[idx - 1], tf.transpose(self.D[idx - 1, idx:]))
-            q_vec[idx:].assign(q_vec[idx:] - to_subtract)
-
-        q_vec = q_vec / (self.m + diag_part(self.D))
-        q_vec = tf.expand_dims(q_vec, axis=1)
-        to_subtract = matmul(q_vec, self.B, transpose_a=True)
-        to_subtract = matmul(to_subtract, self.GradFifo.values)
-        to_subtract = tf.transpose(to_subtract)
-        result = scalmul(self.damp, vec) - tf.squeeze(to_subtract)
-        return result
@@ -1,23 +1,55 @@
+import csv
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Union
+from typing import List, Union
 
+import tensorflow as tf
 from numpy import unique as unique
 from omegaconf import OmegaConf
 
-from src.utils.datasets import UnknownNameError, get_dataset, get_model, load_optimizer
+from src.utils.datasets import (
+    UnknownNameError,
+    get_dataset,
+    get_model,
+    get_tf_dataset,
+    load_optimizer,
+    load_strategy,
+)
 from src.utils.helper_functions import (
     get_param_combo_list,
     set_log_dir,
     set_log_filename_default,
     set_log_filename_mfac,
 )
-from src.utils.monitor_training import CustomCSVLogger
+from src.utils.monitor_training import (
+    CustomCSVLogger,
+    HistorySizeScheduler,
+    StepTimeProfiler,
+)
 
 project_dir = Path(__file__).resolve().parents[1]
 config_path = Path(project_dir, "conf")
 
 
 def run_experiment(conf_name: Union[str, Path], conf_path: Union[str, Path] = config_path) -> None:
+    """Run every optimizer, run and parameter combination of a configuration.
+
+    Combinations whose CSV log already holds all epochs are skipped, so an
+    interrupted sweep resumes where it stopped. With `workers` or `cores` in the
+    configuration the combinations run as independent jobs on a pool of
+    `workers` processes that share the budget of `cores` threads, see
+    pool_size.
+
+    Args:
+        conf_name: name of the yaml file in conf_path
+        conf_path: directory of the configuration files
+    """
     config_file = Path(conf_path, conf_name + ".yaml")
     if not config_file.exists():
         raise UnknownNameError(f"Configuration file {config_file} not found.")
@@ -25,74 +57,251 @@ def run_experiment(conf_name: Union[str, Path], conf_path: Union[str, Path] = co
     log_dir = set_log_dir(root=project_dir)
     config_name = "experiment2"
     log_dir = set_log_dir(root=log_dir, name=config_name)
-    dataset_name = conf.dataset
-    model_name = conf.model
-    x_train, y_train, x_test, y_test = get_dataset(dataset_name)
-    input_shape = x_train.shape[1:]
-    n_classes = len(unique(y_train))
-    epochs = conf.epochs
-    loss = conf.loss
+    jobs = [
+        job
+        for job in expand_jobs(conf)
+        if not log_complete(Path(log_dir, job["optimizer_name"]), job["log_name"], conf.epochs)
+    ]
+    if conf.get("workers") is None and conf.get("cores") is None:
+        for job in jobs:
+            run_job(conf, job, log_dir)
+        return
+    workers, threads = pool_size(conf.get("workers", 1), conf.get("cores", os.cpu_count()))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        # tensorflow is not fork safe
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=limit_threads,
+        initargs=(threads,),
+    ) as pool:
+        futures = [pool.submit(run_job, conf, job, log_dir) for job in jobs]
+        for future in as_completed(futures):
+            future.result()
+
+
+def expand_jobs(conf) -> List[dict]:
+    """Expand a configuration into one job per optimizer, run and parameter combination.
+
+    Args:
+        conf: experiment configuration
+
+    Returns:
+        list of dictionaries with optimizer_name, run, param_combo, batch_size,
+        min_m and the log_name without its time stamp.
+    """
+    jobs = []
     for optimizer_name in conf.optimizer:
         optimizer_dict = conf["optimizer"][optimizer_name]
-        optimizer_params = optimizer_dict.params
-        param_combos = get_param_combo_list(optimizer_params)
+        param_combos = get_param_combo_list(optimizer_dict.params)
         batch_size = optimizer_dict.batch_size
+        # MFAC optimizers with min_m shrink their history while training does not slow down
+        min_m = optimizer_dict.get("min_m")
+        optimizer_jobs = []
         for run in range(conf.runs):
             for param_combo in param_combos:
-                # set optimizer
-                if optimizer_name.lower().startswith("mfac"):
-                    optimizer = load_optimizer(optimizer_name, param_combo)
-                elif optimizer_name.lower().startswith("f-mfac-sgd"):
-                    optimizer = load_optimizer(optimizer_name, param_combo)
-                elif optimizer_name.lower() == "adam":
-                    optimizer = load_optimizer(optimizer_name, param_combo)
-                elif optimizer_name.lower() == "sgd":
-                    optimizer = load_optimizer(optimizer_name, param_combo)
-                elif optimizer_name.lower() == "f-mfac-adam":
-                    optimizer = load_optimizer(optimizer_name, param_combo)
-                else:
-                    raise UnknownNameError(
-                        f"Optimizer {optimizer_name} currently not implemented in training."
+                if min_m is not None:
+                    param_combo = dict(param_combo, resizable_history=True)
+                if conf.get("profile", False) and "mfac" in optimizer_name.lower():
+                    param_combo = dict(param_combo, profile=True)
+                log_name = _log_filename(
+                    optimizer_name, conf.model, batch_size, run, param_combo
+                ).split("_", 1)[1]
+                optimizer_jobs.append(
+                    dict(
+                        optimizer_name=optimizer_name,
+                        run=run,
+                        param_combo=param_combo,
+                        batch_size=batch_size,
+                        min_m=min_m,
+                        log_name=log_name,
                     )
+                )
+        # combinations the file name does not tell apart get a hash of their parameters
+        names = Counter(job["log_name"] for job in optimizer_jobs)
+        for job in optimizer_jobs:
+            if names[job["log_name"]] > 1:
+                params = json.dumps(dict(job["param_combo"]), sort_keys=True, default=str)
+                job["log_name"] += "_params-" + hashlib.sha256(params.encode()).hexdigest()[:8]
+        jobs.extend(optimizer_jobs)
+    return jobs
 
-                # set variables for configuration logging
-                if "mfac" in optimizer_name.lower():
-                    conf_name = set_log_filename_mfac(
-                        optimizer_name, model_name, batch_size, run, param_combo.get("m")
-                    )
-                else:
-                    conf_name = set_log_filename_default(
-                        optimizer_name, model_name, batch_size, run
-                    )
-                # for each optimizer create dedicated log folder
-                optimizer_log_dir = Path(project_dir, log_dir, optimizer_name)
 
-                if not optimizer_log_dir.is_dir():
-                    optimizer_log_dir.mkdir(exist_ok=True)
+def job_logs(optimizer_log_dir: Path, log_name: str) -> List[Path]:
+    """Return the CSV logs of a job, whatever their time stamps, oldest first."""
+    return sorted(Path(optimizer_log_dir).glob(f"*_{log_name}.csv"))
 
-                csv_logger = CustomCSVLogger(Path(optimizer_log_dir, conf_name + ".csv"))
 
-                # reset model
-                model = None
-                model = get_model(model_name, n_classes=n_classes, input_shape=input_shape)
+def log_complete(optimizer_log_dir: Path, log_name: str, epochs: int) -> bool:
+    """Whether a CSV log of the job holds all epochs, whatever its time stamp.
 
-                if "mfac" in optimizer_name.lower():
-                    bool_eagerly = True
-                else:
-                    bool_eagerly = False
+    A run resumed from a backup may log an epoch twice, so the distinct values
+    of the epoch column are counted, not the rows.
+    """
+    for log_file in job_logs(optimizer_log_dir, log_name):
+        with open(log_file, newline="") as file:
+            if len({row["epoch"] for row in csv.DictReader(file)}) >= epochs:
+                return True
+    return False
 
-                model.compile(
-                    optimizer=optimizer, loss=loss, metrics=["accuracy"], run_eagerly=bool_eagerly
-                )
 
-                model.fit(
-                    x_train,
-                    y_train,
-                    validation_data=(x_test, y_test),
-                    epochs=epochs,
-                    batch_size=batch_size,
-                    callbacks=[csv_logger],
-                )
+def pool_size(workers: int, cores: int) -> tuple:
+    """Return the number of worker processes and the threads of each.
+
+    Every worker gets at least one of the `cores`, so there are at most
+    `cores` workers.
+
+    Args:
+        workers: int, requested number of worker processes
+        cores: int, number of cores all workers share
+
+    Returns:
+        tuple of the numbers of workers and of threads per worker
+    """
+    if workers < 1 or cores < 1:
+        raise ValueError("`workers` and `cores` must be at least 1.")
+    workers = min(workers, cores)
+    return workers, cores // workers
+
+
+def limit_threads(threads: int) -> None:
+    """Bound the thread pools of tensorflow in a worker process before it starts."""
+    intra, inter = split_threads(threads)
+    tf.config.threading.set_intra_op_parallelism_threads(intra)
+    tf.config.threading.set_inter_op_parallelism_threads(inter)
+
+
+def split_threads(threads: int) -> tuple:
+    """Split a budget of threads into intra-op and inter-op threads.
+
+    Up to two inter-op threads run independent ops, the rest computes within
+    ops. Each pool gets at least one thread, so only a budget of one thread is
+    exceeded.
+
+    Args:
+        threads: int, number of threads of a worker process
+
+    Returns:
+        tuple of the numbers of intra-op and inter-op threads
+    """
+    inter = min(2, max(1, threads // 2))
+    return max(1, threads - inter), inter
+
+
+def run_job(conf, job: dict, log_dir: Path) -> None:
+    """Train one optimizer, run and parameter combination of a configuration.
+
+    Args:
+        conf: experiment configuration
+        job: dictionary as returned by expand_jobs
+        log_dir: directory of the optimizer log folders
+    """
+    dataset_name = conf.dataset
+    model_name = conf.model
+    epochs = conf.epochs
+    loss = conf.loss
+    optimizer_name = job["optimizer_name"]
+    run = job["run"]
+    param_combo = job["param_combo"]
+    batch_size = job["batch_size"]
+    min_m = job["min_m"]
+    if param_combo.get("history_path") is not None:
+        # memory-mapped histories of parallel jobs must not share files
+        param_combo = dict(
+            param_combo, history_path=str(Path(param_combo["history_path"], job["log_name"]))
+        )
+    # optimizer state and model variables are created in the strategy's scope
+    strategy = load_strategy(conf.get("distribute"))
+    # preprocessed datasets are shared on disk between runs and processes
+    cache_dir = conf.get("cache_dir")
+    # streamed with tf.data instead of float32 arrays in memory
+    if conf.get("streaming", False):
+        train_data, test_data, input_shape, n_classes = get_tf_dataset(
+            dataset_name, batch_size, seed=run, cache_dir=cache_dir
+        )
+        fit_data = dict(x=train_data, validation_data=test_data)
+    else:
+        x_train, y_train, x_test, y_test = _load_dataset(dataset_name, cache_dir)
+        input_shape = x_train.shape[1:]
+        n_classes = len(unique(y_train))
+        fit_data = dict(
+            x=x_train, y=y_train, validation_data=(x_test, y_test), batch_size=batch_size
+        )
+    with strategy.scope():
+        # set optimizer
+        if optimizer_name.lower().startswith("mfac"):
+            optimizer = load_optimizer(optimizer_name, param_combo)
+        elif optimizer_name.lower().startswith("f-mfac-sgd"):
+            optimizer = load_optimizer(optimizer_name, param_combo)
+        elif optimizer_name.lower() == "adam":
+            optimizer = load_optimizer(optimizer_name, param_combo)
+        elif optimizer_name.lower() == "sgd":
+            optimizer = load_optimizer(optimizer_name, param_combo)
+        elif optimizer_name.lower().startswith("f-mfac-"):
+            optimizer = load_optimizer(optimizer_name, param_combo)
+        else:
+            raise UnknownNameError(
+                f"Optimizer {optimizer_name} currently not implemented in training."
+            )
+
+        # set variables for configuration logging, the time stamp prefixes the job's log name
+        conf_name = _log_filename(optimizer_name, model_name, batch_size, run, param_combo)
+        conf_name = conf_name.split("_", 1)[0] + "_" + job["log_name"]
+        # for each optimizer create dedicated log folder
+        optimizer_log_dir = Path(project_dir, log_dir, optimizer_name)
+
+        if not optimizer_log_dir.is_dir():
+            optimizer_log_dir.mkdir(exist_ok=True)
+
+        # logs of interrupted attempts are replaced, get_optimzerfolder_dataframe reads all
+        log_file = Path(optimizer_log_dir, conf_name + ".csv")
+        partial_logs = job_logs(optimizer_log_dir, job["log_name"])
+        if conf.get("backup", False) and partial_logs:
+            # the resumed run continues the log of the interrupted one
+            log_file = partial_logs.pop()
+        for partial_log in partial_logs:
+            partial_log.unlink()
+        callbacks = [CustomCSVLogger(log_file, append=conf.get("backup", False))]
+        if conf.get("backup", False):
+            # resumes an interrupted run with weights and optimizer state
+            backup_dir = Path(optimizer_log_dir, "backup", job["log_name"])
+            callbacks.append(tf.keras.callbacks.BackupAndRestore(backup_dir))
+        if min_m is not None:
+            callbacks.append(HistorySizeScheduler(min_m))
+        if conf.get("profile", False):
+            # seconds of every step and of its MFAC phases
+            callbacks.append(StepTimeProfiler(Path(optimizer_log_dir, conf_name + "_steps.npz")))
+
+        # reset model
+        model = None
+        if conf.get("shared_init", False):
+            # built once per process, every optimizer of a run starts from the same weights
+            model = get_model(
+                model_name,
+                n_classes=n_classes,
+                input_shape=input_shape,
+                seed=run,
+                cache_dir=cache_dir,
+            )
+        else:
+            model = get_model(model_name, n_classes=n_classes, input_shape=input_shape)
+
+        model.compile(optimizer=optimizer, loss=loss, metrics=["accuracy"])
+
+        model.fit(**fit_data, epochs=epochs, callbacks=callbacks)
+
+
+def _log_filename(optimizer_name, model_name, batch_size, run, param_combo) -> str:
+    if "mfac" in optimizer_name.lower():
+        return set_log_filename_mfac(
+            optimizer_name, model_name, batch_size, run, param_combo.get("m")
+        )
+    return set_log_filename_default(optimizer_name, model_name, batch_size, run)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_dataset(name, cache_dir):
+    """Load a dataset once per process for all jobs it runs."""
+    return get_dataset(name, cache_dir=cache_dir)
 
 
 if __name__ == "__main__":
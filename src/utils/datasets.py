@@ -1,5 +1,16 @@
 """Function to load dataset and model."""
 
+import functools
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import warnings
+from pathlib import Path
+
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras.datasets as mnist
 import tensorflow_datasets as tfds
@@ -8,6 +19,7 @@ from tensorflow.keras import layers, models
 from tensorflow.keras.datasets import cifar10, cifar100
 from tensorflow.keras.utils import to_categorical
 
+from src.optimizers.F_MFAC import MFAC_ARGUMENTS, with_mfac
 from src.optimizers.F_MFAC_ADAM import Adam_Mfac
 from src.optimizers.F_MFAC_SGD import Mfac
 from src.optimizers.MFAC import MFAC
@@ -17,6 +29,9 @@ from src.utils.helper_functions import build_resnet_20, build_resnet_32
 def load_optimizer(name: str, params: dict):
     """Load the desired optimizer.
 
+    Besides the named ones "f-mfac-<parent>" loads any keras optimizer, e.g.
+    "f-mfac-rmsprop" or "f-mfac-adamw", with MFAC preconditioning.
+
     Args:
         name: string for optimizer name
         params: dictionary of all necessary parameter values.
@@ -38,10 +53,50 @@ def load_optimizer(name: str, params: dict):
         return MFAC(**params)
     elif name == "f-mfac-adam":
         return Adam_Mfac(**params)
+    elif name.startswith("f-mfac-") and name[len("f-mfac-") :] in _keras_optimizers():
+        base_class = _keras_optimizers()[name[len("f-mfac-") :]]
+        mfac_params = {key: value for key, value in params.items() if key in MFAC_ARGUMENTS}
+        base_params = {key: value for key, value in params.items() if key not in MFAC_ARGUMENTS}
+        return with_mfac(base_class(**base_params), **mfac_params)
     else:
         raise UnknownNameError(f"Given Optimizer name '{name}' is not implemeted.")  # noqa E501
 
 
+def _keras_optimizers() -> dict:
+    """Map lower case class names to the optimizer classes of keras."""
+    return {
+        name.lower(): cls
+        for name, cls in vars(tf.keras.optimizers).items()
+        if isinstance(cls, type)
+        and issubclass(cls, tf.keras.optimizers.Optimizer)
+        and cls is not tf.keras.optimizers.Optimizer
+    }
+
+
+def load_strategy(name=None):
+    """Load the tf.distribute strategy models are trained with.
+
+    Args:
+        name: None for the default strategy on one device, "mirrored" for all
+            local devices or "multi_worker" for the workers in TF_CONFIG
+
+    Returns:
+        tf.distribute.Strategy
+
+    Raises:
+        UnknownNameError exception.
+    """
+    if name is None:
+        return tf.distribute.get_strategy()
+    name = name.lower()
+    if name == "mirrored":
+        return tf.distribute.MirroredStrategy()
+    elif name == "multi_worker":
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    else:
+        raise UnknownNameError(f"Given strategy name '{name}' is not implemented.")
+
+
 class UnknownNameError(Exception):
     def __init__(self, name):
         self.name = name
@@ -69,9 +124,157 @@ def extract_text_and_labels(text, label):
     return text, tf.cast(label, tf.int32)
 
 
-def get_dataset(name: str):
-    """ """
+def get_tf_dataset(
+    name: str, batch_size: int, seed: int = 0, cache_dir=None, shuffle_buffer: int = 10000
+):
+    """Load a dataset as tf.data pipelines that stream float32 batches.
+
+    The images stay in memory as uint8, only a batch at a time is converted to
+    float32, in parallel with training and prefetched. Without cache the shuffle
+    permutes indices and batches are gathered from the uint8 images.
+
+    Args:
+        name: string for dataset name, see get_dataset
+        batch_size: int, number of examples per batch
+        seed: int, seed of the shuffle, which differs from epoch to epoch
+        cache_dir: directory to cache the converted examples in, None for no cache.
+            A cache is named by the hash of the dataset, split and preprocessing.
+            The shuffle then draws from a buffer of `shuffle_buffer` examples.
+        shuffle_buffer: int, number of cached examples the shuffle draws from
+
+    Returns:
+        tuple of train and test tf.data.Dataset, the input shape and the number of
+        classes.
+
+    Raises:
+        UnknownNameError exception.
+    """
+    (x_train, y_train), (x_test, y_test) = _load_raw_dataset(name, cache_dir)
+    cache_files = [None, None]
+    if cache_dir is not None:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        keys = [
+            {"dataset": name.lower(), "split": split, "preprocessing": "scale/255"}
+            for split in ("train", "test")
+        ]
+        cache_files = [str(_cache_entry(cache_dir, key)) for key in keys]
+    train = stream_arrays(x_train, y_train, batch_size, seed, cache_files[0], shuffle_buffer)
+    test = stream_arrays(x_test, y_test, batch_size, cache_file=cache_files[1])
+    return train, test, x_train.shape[1:], len(np.unique(y_train))
+
+
+def stream_arrays(x, y, batch_size, seed=None, cache_file=None, shuffle_buffer=10000):
+    """Build a tf.data pipeline of float32 batches from uint8 images.
+
+    Args:
+        x: uint8 array of images
+        y: array of labels
+        batch_size: int, number of examples per batch
+        seed: int, seed of the shuffle, None to keep the order
+        cache_file: directory to cache the converted examples in, None for no cache.
+            A complete cache is reused as is, whatever x and y are.
+        shuffle_buffer: int, number of cached examples the shuffle draws from
+
+    Returns:
+        tf.data.Dataset of (images, labels) batches
+    """
+    autotune = tf.data.AUTOTUNE
+    if cache_file is not None:
+        dataset = tf.data.Dataset.from_tensor_slices((x, y))
+        dataset = dataset.map(_to_float, num_parallel_calls=autotune)
+        dataset = dataset.cache(_complete_cache(dataset, cache_file))
+        if seed is not None:
+            dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+        return dataset.batch(batch_size).prefetch(autotune)
+    images, labels = tf.constant(x), tf.constant(y)
+    dataset = tf.data.Dataset.range(len(x))
+    if seed is not None:
+        # a shuffle buffer of indices instead of images
+        dataset = dataset.shuffle(len(x), seed=seed)
+    dataset = dataset.batch(batch_size).map(
+        lambda idx: _to_float(tf.gather(images, idx), tf.gather(labels, idx)),
+        num_parallel_calls=autotune,
+        deterministic=True,
+    )
+    return dataset.prefetch(autotune)
+
+
+def _complete_cache(dataset, cache_file) -> str:
+    """Write the tf.data cache of a dataset unless it is complete.
+
+    tf.data writes a cache during the first full iteration and locks it with a
+    lockfile, so a concurrent process fails on the lock and a killed one leaves
+    it stale. Instead one full pass writes the cache into a temporary directory,
+    which is published with an atomic rename like in cached_arrays.
+
+    Args:
+        dataset: tf.data.Dataset to cache
+        cache_file: directory of the cache
+
+    Returns:
+        file prefix of the complete cache
+    """
+    entry = Path(cache_file)
+    if not entry.exists():
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix=f".{entry.name}-", dir=entry.parent))
+        dataset.cache(str(tmp / "cache")).reduce(np.int64(0), lambda count, *_: count + 1)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process published the cache first
+            shutil.rmtree(tmp)
+    return str(entry / "cache")
+
+
+def _to_float(image, label):
+    return tf.cast(image, tf.float32) / 255.0, label
+
+
+def _load_raw_dataset(name: str, cache_dir=None):
+    """Load train and test split of a dataset as stored, i.e. uint8 images."""
     name = name.lower()
+    if cache_dir is not None:
+        x_train, y_train, x_test, y_test = cached_arrays(
+            cache_dir,
+            {"dataset": name, "preprocessing": None},
+            lambda: _flatten_splits(_load_raw_dataset(name)),
+        )
+        return (x_train, y_train), (x_test, y_test)
+    if name == "cifar100":
+        return cifar100.load_data(label_mode="fine")
+    elif name == "cifar10":
+        return cifar10.load_data()
+    elif name == "mnist":
+        return tf.keras.datasets.mnist.load_data()
+    else:
+        raise UnknownNameError(f"Requested dataset {name} not implemented.")
+
+
+def _flatten_splits(splits):
+    (x_train, y_train), (x_test, y_test) = splits
+    return x_train, y_train, x_test, y_test
+
+
+def get_dataset(name: str, cache_dir=None):
+    """Load train and test split of a dataset with images scaled to [0, 1].
+
+    Args:
+        name: string for dataset name
+        cache_dir: directory of the preprocessed dataset cache, None for no cache.
+            Cached arrays are memory-mapped read-only.
+
+    Returns:
+        tuple of x_train, y_train, x_test, y_test arrays
+
+    Raises:
+        UnknownNameError exception.
+    """
+    name = name.lower()
+    if cache_dir is not None:
+        return cached_arrays(
+            cache_dir, {"dataset": name, "preprocessing": "scale/255"}, lambda: get_dataset(name)
+        )
     if name == "cifar100":
         (x_train, y_train), (x_test, y_test) = cifar100.load_data(label_mode="fine")
         x_train = x_train.astype("float32") / 255
@@ -93,8 +296,126 @@ def get_dataset(name: str):
         raise UnknownNameError(f"Requested dataset {name} not implemented.")
 
 
-def get_model(name: str, n_classes, input_shape=None, top=False, weights=None):
-    """ """
+def cached_arrays(cache_dir, key: dict, build):
+    """Load arrays from a content-addressed cache, building them on a miss.
+
+    An entry lives in a directory named by the hash of `key` and is published
+    with an atomic rename, so concurrent processes either see a complete entry
+    or build their own and the first rename wins.
+
+    Args:
+        cache_dir: directory of the cache
+        key: json serializable dict of everything the arrays depend on
+        build: function without arguments returning a tuple of arrays
+
+    Returns:
+        tuple of read-only memory-mapped arrays
+    """
+    entry = _cache_entry(cache_dir, key)
+    manifest = entry / "manifest.json"
+    if not manifest.exists():
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        arrays = build()
+        tmp = Path(tempfile.mkdtemp(prefix=f".{entry.name}-", dir=cache_dir))
+        for i, array in enumerate(arrays):
+            np.save(tmp / f"{i}.npy", np.ascontiguousarray(array))
+        (tmp / "manifest.json").write_text(json.dumps({"key": key, "arrays": len(arrays)}))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process published the entry first
+            shutil.rmtree(tmp)
+    n_arrays = json.loads(manifest.read_text())["arrays"]
+    return tuple(np.load(entry / f"{i}.npy", mmap_mode="r") for i in range(n_arrays))
+
+
+def _cache_entry(cache_dir, key: dict) -> Path:
+    """Return the path of the cache entry of `key`, named by its hash."""
+    key_json = json.dumps(key, sort_keys=True)
+    return Path(cache_dir, hashlib.sha256(key_json.encode()).hexdigest()[:16])
+
+
+def get_model(
+    name: str, n_classes, input_shape=None, top=False, weights=None, seed=None, cache_dir=None
+):
+    """Load a model by name.
+
+    With a seed the architecture is built once per process, or on every call
+    under a tf.distribute strategy, whose variables cannot be reused by the
+    strategy of the next job. The model gets the initial weights of the seed,
+    so all optimizers of a run start from the same point. The random state of
+    the process stays as it was.
+
+    Args:
+        name: string for model name
+        n_classes: int, number of classes
+        input_shape: shape of a single input
+        top: unused
+        weights: unused
+        seed: int seed of the initial weights, None for a freshly built model
+        cache_dir: directory to snapshot the initial weights per seed in, so
+            other processes restore instead of initialize them, None for no snapshot
+
+    Returns:
+        tf.keras.Model, shared between the calls with a seed without strategy
+
+    Raises:
+        UnknownNameError exception.
+    """
+    if seed is None:
+        return _build_model(name, n_classes, input_shape)
+    name = name.lower()
+    input_shape = None if input_shape is None else tuple(input_shape)
+    if tf.distribute.has_strategy():
+        # variables belong to the strategy they were created with
+        model = _build_model(name, n_classes, input_shape)
+    else:
+        model = _model_template(name, n_classes, input_shape)
+    model.set_weights(_initial_weights(name, n_classes, input_shape, seed, cache_dir))
+    return model
+
+
+@functools.lru_cache(maxsize=4)
+def _model_template(name, n_classes, input_shape):
+    return _build_model(name, n_classes, input_shape)
+
+
+@functools.lru_cache(maxsize=None)
+def _initial_weights(name, n_classes, input_shape, seed, cache_dir):
+    """Initial weights of a model for a seed, restored from cache_dir if snapshotted."""
+    snapshot = None
+    if cache_dir is not None:
+        shape = "x".join(str(dim) for dim in input_shape or ())
+        snapshot = Path(cache_dir, f"{name}_classes-{n_classes}_input-{shape}_seed-{seed}.npz")
+        if snapshot.exists():
+            with np.load(snapshot) as stored:
+                return [stored[f"arr_{i}"] for i in range(len(stored.files))]
+    # keras seeds its initializers with random.randint(1, 1e9), so seeding python's
+    # generator fixes the weights, its state and numpy's are restored afterwards
+    states = random.getstate(), np.random.get_state()
+    try:
+        random.seed(int(seed))
+        np.random.seed(int(seed))
+        with warnings.catch_warnings():
+            warnings.filterwarnings(
+                "ignore", "non-integer arguments to randrange", DeprecationWarning
+            )
+            weights = _build_model(name, n_classes, input_shape).get_weights()
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+    if snapshot is not None:
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        # published atomically, concurrent processes write identical weights
+        fd, tmp = tempfile.mkstemp(suffix=".npz", dir=snapshot.parent)
+        with os.fdopen(fd, "wb") as file:
+            np.savez(file, *weights)
+        os.replace(tmp, snapshot)
+    return weights
+
+
+def _build_model(name: str, n_classes, input_shape=None):
+    """Build a freshly initialized model."""
     name = name.lower()
     if name == "resnet20":
         model = build_resnet_20(input_shape=input_shape, num_classes=n_classes)
@@ -1,4 +1,5 @@
 """Helper functions used in models and optimizers module."""
+import contextlib
 import datetime
 import itertools
 import os
@@ -232,12 +233,145 @@ class RowWiseMatrixFifo:
     The top row contains the newest vector (row-wise).
     The matrix is initializes with zeros and when appended the firt m-1 rows
     move rown row down and the row on top is replaced by vector.
+
+    In circular mode no rows are moved. The newest vector overwrites the slot
+    of the oldest one and ``head`` points to it, so an append only writes a
+    single row. ``order`` gives the slots in logical order (newest first),
+    i.e. ``tf.gather(values, order)`` equals the matrix of the shifting mode.
+
+    With ``track_gram`` the raw Gram matrix ``values @ values^T`` is kept up
+    to date on every append by refreshing only the row and column of the
+    replaced vector, which costs O(m*d) instead of O(m^2*d).
+
+    All state, including ``counter`` and ``head``, lives in variables that are
+    allocated once in ``build``, so ``append`` can run inside a ``tf.function``.
+
+    ``dtype`` sets the storage type of the matrix. float16 and bfloat16 rows
+    are plain casts, int8 rows are quantized symmetrically with one float32
+    scale per row. ``matvec``, ``rmatvec`` and ``gram_matrix`` always compute
+    in float32 on the dequantized rows.
+
+    With ``tile_size`` the matrix is stored tile-major, as ceil(d / tile_size)
+    tiles of m x tile_size with the last one zero padded. The products read
+    one tile at a time with a gather of its leading index, so neither the
+    temporaries nor the reads are larger than m*tile_size. Slicing columns of
+    an m x d variable would read the whole matrix for every tile. float16,
+    bfloat16 and int8 matrices without ``tile_size`` are tiled by
+    ``dequantized_tile_size`` columns, otherwise their float32 copy would be
+    larger than the stored matrix.
+
+    In circular mode ``resize`` changes the ``capacity`` of the ring at
+    runtime, i.e. how many of the m slots are used. The stored vectors are
+    always in the leading min(counter, capacity) slots, the rest is zero.
     """
 
-    def __init__(self, m):
+    # columns per tile of a matrix stored in a smaller dtype than float32
+    dequantized_tile_size = 2**16
+
+    def __init__(self, m, circular=False, track_gram=False, dtype="float32", tile_size=None):
         self.values = None
+        self.tile_size = tile_size
+        self.ncol = None
+        self.n_tiles = None
+        self.scales = None
+        self.gram = None
         self.nrow = m
-        self.counter = 0  # tf.Variable(0, dtype=tf.int32)
+        self.circular = circular
+        self.track_gram = track_gram
+        self.dtype = tf.as_dtype(dtype)
+        if self.dtype not in (tf.float32, tf.float16, tf.bfloat16, tf.int8):
+            raise ValueError(f"Unsupported storage dtype '{self.dtype.name}'.")
+        self.head = None
+        self.counter = None
+        self.capacity = None
+
+    def build(self, ncol: int, add_variable=None):
+        """Allocate the zero initialized fifo matrix and its bookkeeping.
+
+        Does nothing if the fifo is already built.
+
+        Args:
+            ncol: length of the vectors to store.
+            add_variable: function with arguments shape, dtype, initializer and name
+                creating a variable, e.g. `Optimizer.add_variable`, so the fifo is
+                checkpointed with its owner. Plain variables by default.
+        """
+        if self.values is not None:
+            return
+        self.add_variable = add_variable or new_variable
+        self.ncol = ncol
+        if self.tile_size is None and self.dtype != tf.float32 and self.dequantized_tile_size:
+            self.tile_size = min(ncol, self.dequantized_tile_size)
+        if self.tiled:
+            self.n_tiles = -(-ncol // self.tile_size)
+        self.values = self._allocate(ncol)
+        if self.quantized:
+            self.scales = self.add_variable(shape=(self.nrow,), dtype=tf.float32, name="scales")
+        self.counter = self.add_variable(shape=(), dtype=tf.int64, name="counter")
+        self.head = self.add_variable(shape=(), dtype=tf.int32, name="head")
+        self.capacity = self.add_variable(
+            shape=(),
+            dtype=tf.int32,
+            initializer=tf.keras.initializers.Constant(self.nrow),
+            name="capacity",
+        )
+        if self.track_gram:
+            self.gram = self.add_variable(
+                shape=(self.nrow, self.nrow), dtype=tf.float32, name="gram"
+            )
+
+    def _allocate(self, ncol: int):
+        """Create the storage of the fifo matrix."""
+        shape = (self.n_tiles, self.nrow, self.tile_size) if self.tiled else (self.nrow, ncol)
+        return self.add_variable(shape=shape, dtype=self.dtype, name="values")
+
+    @property
+    def tiled(self) -> bool:
+        """Whether the matrix is stored tile-major."""
+        return self.tile_size is not None
+
+    def _split(self, vectors: tf.Tensor) -> tf.Tensor:
+        """Split the last axis of vectors into zero padded tiles along a new axis."""
+        if not self.tiled:
+            return vectors
+        padding = self.n_tiles * self.tile_size - self.ncol
+        axis = vectors.shape.rank - 1
+        vectors = tf.pad(vectors, [[0, 0]] * axis + [[0, padding]])
+        return tf.reshape(vectors, vectors.shape[:axis] + [self.n_tiles, self.tile_size])
+
+    def _write_row(self, slot: tf.Tensor, row: tf.Tensor):
+        """Overwrite row `slot` of the fifo matrix with `row`."""
+        if not self.tiled:
+            self._scatter(self.values, tf.reshape(slot, [1, 1]), tf.expand_dims(row, 0))
+            return
+        tiles = tf.range(self.n_tiles, dtype=tf.int32)
+        slots = tf.fill([self.n_tiles], tf.cast(slot, tf.int32))
+        self._scatter(self.values, tf.stack([tiles, slots], axis=1), self._split(row))
+
+    def _scatter(self, variable: tf.Variable, indices: tf.Tensor, updates: tf.Tensor):
+        """Write updates to the entries of variable at indices."""
+        variable.scatter_nd_update(indices, updates)
+
+    @property
+    def quantized(self) -> bool:
+        """Whether rows are stored as int8 with a scale per row."""
+        return self.dtype == tf.int8
+
+    def _encode(self, vector: tf.Tensor):
+        """Convert vector to the storage dtype.
+
+        Args:
+            vector: float32 vector.
+
+        Returns:
+            tuple of the stored row and its scale (1 if not quantized).
+        """
+        if not self.quantized:
+            return tf.cast(vector, self.dtype), tf.ones([])
+        scale = tf.reduce_max(tf.abs(vector)) / 127.0
+        scale = tf.where(scale > 0, scale, tf.ones_like(scale))
+        row = tf.cast(tf.clip_by_value(tf.round(vector / scale), -127.0, 127.0), tf.int8)
+        return row, scale
 
     def append(self, vector: tf.Tensor):
         """Append vector to fifoMatrix
@@ -250,43 +384,692 @@ class RowWiseMatrixFifo:
             vector: tf.Vector of gradients
         """
         if self.values is None:
-            # init zero matrix
-            # this is done here so the shape of vector determines ncol
-            # and is not set at init.
-            self.values = tf.Variable(tf.zeros(shape=[self.nrow, vector.shape[0]]))  # noqa E501
-
-        # first m-1 rows are part of updated fifo matrix.
-        maintained_values = tf.identity(self.values[: self.nrow - 1, :])
-        # move row i is now former row i - 1.
-        self.values[1:, :].assign(maintained_values)
-        # update firt row with new vector.
-        self.values[0, :].assign(vector)
+            # if not built beforehand the shape of vector determines ncol.
+            self.build(vector.shape[0])
+
+        row, scale = self._encode(vector)
+        if self.circular:
+            # overwrite oldest slot, no other row is touched.
+            capacity = tf.cast(self.capacity, tf.int64)
+            head = self.head.assign(tf.cast(self.counter % capacity, tf.int32))
+            self._write_row(head, row)
+            if self.quantized:
+                self._scatter(self.scales, tf.reshape(head, [1, 1]), tf.reshape(scale, [1]))
+        elif self.tiled:
+            # row i of every tile is now former row i - 1, the first row the new vector.
+            rows = tf.concat([self._split(row)[:, None], self.values[:, : self.nrow - 1]], axis=1)
+            self.values.assign(rows)
+        else:
+            # first m-1 rows are part of updated fifo matrix.
+            maintained_values = tf.identity(self.values[: self.nrow - 1, :])
+            # move row i is now former row i - 1.
+            self.values[1:, :].assign(maintained_values)
+            # update firt row with new vector.
+            self.values[0, :].assign(row)
+            if self.quantized:
+                self.scales[1:].assign(tf.identity(self.scales[: self.nrow - 1]))
+                self.scales[0].assign(scale)
+            if self.track_gram:
+                maintained_gram = tf.identity(self.gram[: self.nrow - 1, : self.nrow - 1])
+                self.gram[1:, 1:].assign(maintained_gram)
+        if self.track_gram:
+            # use the stored row, so the gram matrix matches the history
+            self._update_gram(self.head if self.circular else 0, tf.cast(row, tf.float32) * scale)
         # increment counter
-        self.counter += 1  # self.counter.assign_add(1)
+        self.counter.assign_add(1)
+
+    def _update_gram(self, slot, vector: tf.Tensor):
+        """Refresh row and column `slot` of the Gram matrix.
+
+        Args:
+            slot: index of the row that was just written.
+            vector: the vector written to `slot`.
+        """
+        dots = self._row_products(vector)
+        # scatter instead of sliced assigns since slot may be a tensor
+        rows = tf.range(self.nrow, dtype=tf.int32)
+        slots = tf.fill([self.nrow], tf.cast(slot, tf.int32))
+        self._scatter(self.gram, tf.stack([slots, rows], axis=1), dots)
+        self._scatter(self.gram, tf.stack([rows, slots], axis=1), dots)
+
+    def _row_products(self, row: tf.Tensor) -> tf.Tensor:
+        """Compute the products of all stored rows with a row as it is stored."""
+        return self.matvec(row)
+
+    def rows_lost(self) -> tf.Tensor:
+        """Whether stored rows changed outside of the fifo, so D and B are outdated."""
+        return tf.constant(False)
+
+    def _tiles(self, nrows=None):
+        """Yield the index into split vectors and a float32 copy of every tile.
+
+        Vectors passed through ``_split`` indexed with the index along their
+        last axis give the columns of the tile.
+
+        Args:
+            nrows: number of leading slots to read, None for all slots.
+        """
+        if not self.tiled:
+            values = self.values if nrows is None else self.values[:nrows]
+            yield slice(None), tf.cast(values, tf.float32)
+            return
+        for tile in range(self.n_tiles):
+            values = self._read_tile(tile)
+            if nrows is not None:
+                values = values[:nrows]
+            yield tile, tf.cast(values, tf.float32)
+
+    def _read_tile(self, tile: int) -> tf.Tensor:
+        """Read one tile of the tile-major matrix.
+
+        A gather reads only the tile, slicing the variable would read all of it.
+        """
+        return self.values.sparse_read(tile)
+
+    def _leading(self, tensor: tf.Tensor, nrows=None) -> tf.Tensor:
+        """Return the entries of the first nrows slots of tensor."""
+        return tensor if nrows is None else tensor[:nrows]
+
+    def _pad(self, tensor: tf.Tensor, nrows=None, axes=(0,)) -> tf.Tensor:
+        """Pad the slot axes of a tensor over the first nrows slots with zeros to m."""
+        if nrows is None:
+            return tensor
+        paddings = [
+            [0, self.nrow - nrows if axis in axes else 0] for axis in range(tensor.shape.rank)
+        ]
+        shape = [self.nrow if axis in axes else dim for axis, dim in enumerate(tensor.shape)]
+        return tf.ensure_shape(tf.pad(tensor, paddings), shape)
+
+    def matvec(self, vector: tf.Tensor, nrows=None) -> tf.Tensor:
+        """Compute values @ vector in float32.
+
+        Args:
+            vector: float32 vector of length ncol.
+            nrows: number of leading slots holding vectors, None for all. The
+                remaining slots are not read and their entries are zero.
+
+        Returns:
+            float32 vector of length m in slot order.
+        """
+        vector = self._split(vector)
+        result = tf.add_n([tf.linalg.matvec(tile, vector[idx]) for idx, tile in self._tiles(nrows)])
+        if self.quantized:
+            result = result * self._leading(self.scales, nrows)
+        return self._pad(result, nrows)
+
+    def rmatvec(self, coef: tf.Tensor, nrows=None) -> tf.Tensor:
+        """Compute values^T @ coef in float32.
+
+        Args:
+            coef: float32 vector of length m in slot order.
+            nrows: number of leading slots holding vectors, None for all.
+
+        Returns:
+            float32 vector of length ncol.
+        """
+        coef = self._leading(coef, nrows)
+        if self.quantized:
+            coef = coef * self._leading(self.scales, nrows)
+        result = [tf.linalg.matvec(tile, coef, transpose_a=True) for _, tile in self._tiles(nrows)]
+        return tf.concat(result, axis=0)[: self.ncol]
+
+    def matmul(self, vectors: tf.Tensor, nrows=None) -> tf.Tensor:
+        """Compute vectors @ values^T in float32, the matvec of k vectors at once.
+
+        Args:
+            vectors: float32 matrix of k by ncol, one vector per row.
+            nrows: number of leading slots holding vectors, None for all.
+
+        Returns:
+            float32 matrix of k by m with columns in slot order.
+        """
+        vectors = self._split(vectors)
+        result = tf.add_n(
+            [
+                tf.linalg.matmul(vectors[:, idx], tile, transpose_b=True)
+                for idx, tile in self._tiles(nrows)
+            ]
+        )
+        if self.quantized:
+            result = result * self._leading(self.scales, nrows)
+        return self._pad(result, nrows, axes=(1,))
+
+    def rmatmul(self, coefs: tf.Tensor, nrows=None) -> tf.Tensor:
+        """Compute coefs @ values in float32, the rmatvec of k coefficient vectors.
+
+        Args:
+            coefs: float32 matrix of k by m with columns in slot order.
+            nrows: number of leading slots holding vectors, None for all.
+
+        Returns:
+            float32 matrix of k by ncol.
+        """
+        coefs = coefs if nrows is None else coefs[:, :nrows]
+        if self.quantized:
+            coefs = coefs * self._leading(self.scales, nrows)
+        result = [tf.linalg.matmul(coefs, tile) for _, tile in self._tiles(nrows)]
+        return tf.concat(result, axis=1)[:, : self.ncol]
+
+    def gram_matrix(self, nrows=None) -> tf.Tensor:
+        """Return the raw Gram matrix values @ values^T in slot order.
+
+        Args:
+            nrows: number of leading slots holding vectors, None for all.
+
+        Returns:
+            m by m tensor, the tracked one if `track_gram` else computed anew.
+        """
+        if self.track_gram:
+            return tf.identity(self.gram)
+        gram = tf.add_n(
+            [tf.linalg.matmul(tile, tile, transpose_b=True) for _, tile in self._tiles(nrows)]
+        )
+        if self.quantized:
+            scales = self._leading(self.scales, nrows)
+            gram = gram * tf.tensordot(scales, scales, axes=0)
+        return self._pad(gram, nrows, axes=(0, 1))
+
+    def order(self) -> tf.Tensor:
+        """Return the row slots in logical order.
+
+        Logical row i is the i-th newest vector. For the shifting mode this is
+        the identity, in circular mode slot (head - i) mod capacity. Slots beyond
+        the capacity stay in place.
+
+        Returns:
+            int32 tensor of length m with slot indices.
+        """
+        idx = tf.range(self.nrow, dtype=tf.int32)
+        if not self.circular:
+            return idx
+        return tf.where(idx < self.capacity, tf.math.floormod(self.head - idx, self.capacity), idx)
+
+    def resize(self, capacity):
+        """Use `capacity` slots of the circular fifo from now on.
+
+        The newest min(counter, capacity) vectors are kept. They are moved to the
+        leading slots, oldest first, all other slots are zeroed and counter
+        restarts at the number of kept vectors.
+
+        Args:
+            capacity: int, number of slots to use, between 1 and m.
+        """
+        if not self.circular:
+            raise ValueError("Only a circular fifo can be resized.")
+        capacity = tf.convert_to_tensor(capacity, dtype=tf.int32)
+        filled = tf.cast(tf.minimum(self.counter, tf.cast(self.capacity, tf.int64)), tf.int32)
+        keep = tf.minimum(filled, capacity)
+        slots = tf.range(self.nrow, dtype=tf.int32)
+        # slot j gets the (keep - 1 - j)-th newest vector
+        source = tf.gather(self.order(), tf.maximum(keep - 1 - slots, 0))
+        kept = slots < keep
+        self._move_rows(source, kept)
+        if self.quantized:
+            self.scales.assign(tf.where(kept, tf.gather(self.scales, source), 0.0))
+        if self.track_gram:
+            gram = tf.gather(tf.gather(self.gram, source), source, axis=1)
+            both = tf.logical_and(kept[:, None], kept[None, :])
+            self.gram.assign(tf.where(both, gram, 0.0))
+        self.capacity.assign(capacity)
+        self.head.assign(tf.maximum(keep - 1, 0))
+        self.counter.assign(tf.cast(keep, tf.int64))
+
+    def _move_rows(self, source: tf.Tensor, kept: tf.Tensor):
+        """Write row source[j] to slot j where kept[j], zero the other slots."""
+        if self.tiled:
+            rows = tf.gather(self.values, source, axis=1)
+            self.values.assign(tf.where(kept[None, :, None], rows, tf.zeros_like(rows)))
+            return
+        rows = tf.gather(self.values, source)
+        self.values.assign(tf.where(kept[:, None], rows, tf.zeros_like(rows)))
 
     def reset(self):
-        self.counter = 0
-        self.values = None
+        if self.values is None:
+            return
+        self.counter.assign(0)
+        self.head.assign(0)
+        self._clear()
+        if self.quantized:
+            self.scales.assign(tf.zeros_like(self.scales))
+        if self.track_gram:
+            self.gram.assign(tf.zeros_like(self.gram))
+
+    def _clear(self):
+        """Set all entries of the fifo matrix to zero."""
+        self.values.assign(tf.zeros_like(self.values))
+
+
+class MemmapMatrixFifo(RowWiseMatrixFifo):
+    """Circular fifo queue whose matrix is a memory-mapped file.
+
+    Only the replaced row is written on an append. ``matvec``, ``rmatvec``
+    and ``gram_matrix`` stream the file in chunks of ``chunk_rows`` rows, so
+    host memory is bounded by the chunk size instead of by m*d. Counter, head,
+    scales and the Gram matrix stay tensorflow variables.
+
+    The file access runs as ``tf.numpy_function``, so it works inside a
+    ``tf.function`` but cannot be compiled with XLA. Writes count up the
+    variable ``writes`` and reads take it as input, which orders every read
+    after the preceding writes, also inside ``tf.cond`` branches.
+
+    A checkpoint holds the bookkeeping but not the file, which keeps the rows
+    written after the save. Every row write gets a stamp, stored in the
+    variable ``stamps`` and in the file ``<filename>.stamps``. Slots whose
+    stamps differ hold a row the restored state does not describe, or a row of
+    an earlier run, and count as zero rows until they are written again.
+    """
+
+    # the chunks of rows bound the float32 copies
+    dequantized_tile_size = None
+
+    def __init__(self, m, filename, track_gram=True, dtype="float32", chunk_rows=32):
+        super().__init__(m, circular=True, track_gram=track_gram, dtype=dtype)
+        self.filename = Path(filename)
+        self.chunk_rows = chunk_rows
+        self.writes = None
+        self.file_stamps = None
+        self.stamps = None
+        self.row_writes = None
+
+    def build(self, ncol: int, add_variable=None):
+        if self.values is not None:
+            return
+        super().build(ncol, add_variable)
+        self.writes = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.stamps = self.add_variable(shape=(self.nrow,), dtype=tf.int64, name="stamps")
+        # counts all row writes, unlike counter it restarts neither on resize nor reset
+        self.row_writes = self.add_variable(shape=(), dtype=tf.int64, name="row_writes")
+
+    def _allocate(self, ncol: int):
+        """Open the memory-mapped files of the fifo matrix and its stamps.
+
+        Existing files of the right size are kept, so a run resumed from a
+        checkpoint finds the rows whose stamps still match.
+        """
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        stamps_file = Path(f"{self.filename}.stamps")
+        dtype = self.dtype.as_numpy_dtype
+        nbytes = self.nrow * ncol * np.dtype(dtype).itemsize
+        exists = (
+            self.filename.is_file()
+            and self.filename.stat().st_size == nbytes
+            and stamps_file.is_file()
+            and stamps_file.stat().st_size == self.nrow * np.dtype(np.int64).itemsize
+        )
+        mode = "r+" if exists else "w+"
+        self.file_stamps = np.memmap(stamps_file, dtype=np.int64, mode=mode, shape=(self.nrow,))
+        return np.memmap(self.filename, dtype=dtype, mode=mode, shape=(self.nrow, ncol))
+
+    def _valid(self) -> tf.Tensor:
+        """Return for every slot whether the file holds the row the stamps describe."""
+
+        def _file_stamps(writes):
+            return np.array(self.file_stamps)
+
+        file_stamps = tf.numpy_function(_file_stamps, [self.writes], tf.int64)
+        return tf.equal(tf.ensure_shape(file_stamps, [self.nrow]), self.stamps)
+
+    def rows_lost(self) -> tf.Tensor:
+        return tf.logical_not(tf.reduce_all(self._valid()))
+
+    def _chunks(self, nrows=None):
+        """Yield row slices and float32 copies of the fifo matrix chunk by chunk."""
+        nrows = self.nrow if nrows is None or nrows < 0 else int(nrows)
+        for start in range(0, nrows, self.chunk_rows):
+            rows = slice(start, min(start + self.chunk_rows, nrows))
+            yield rows, np.asarray(self.values[rows], dtype=np.float32)
+
+    def _write_row(self, slot: tf.Tensor, row: tf.Tensor):
+        stamp = self.row_writes.assign_add(1)
+        self._scatter(self.stamps, tf.reshape(slot, [1, 1]), tf.reshape(stamp, [1]))
+
+        def write(slot, row, stamp):
+            self.values[slot] = row
+            self.file_stamps[slot] = stamp
+            return np.int64(1)
+
+        self.writes.assign_add(tf.numpy_function(write, [slot, row, stamp], tf.int64))
+
+    def _move_rows(self, source: tf.Tensor, kept: tf.Tensor):
+        self.stamps.assign(tf.where(kept, tf.gather(self.stamps, source), 0))
+
+        def move(source, kept, writes):
+            # fancy indexing reads a copy, so rows are not overwritten while moved
+            rows = np.where(kept[:, None], self.values[source], 0)
+            self.values[:] = rows
+            self.file_stamps[:] = np.where(kept, self.file_stamps[source], 0)
+            return np.int64(1)
+
+        self.writes.assign_add(tf.numpy_function(move, [source, kept, self.writes], tf.int64))
+
+    @staticmethod
+    def _nrows_arg(nrows=None) -> tf.Tensor:
+        """Pass nrows to numpy, -1 standing for all slots."""
+        return tf.constant(-1) if nrows is None else tf.cast(nrows, tf.int32)
+
+    def matvec(self, vector: tf.Tensor, nrows=None) -> tf.Tensor:
+        def _matvec(vector, nrows, writes):
+            result = np.zeros(self.nrow, dtype=np.float32)
+            for rows, chunk in self._chunks(nrows):
+                result[rows] = chunk @ vector
+            return result
+
+        args = [vector, self._nrows_arg(nrows), self.writes]
+        result = tf.numpy_function(_matvec, args, tf.float32)
+        result = tf.ensure_shape(result, [self.nrow])
+        if self.quantized:
+            result = result * self.scales
+        return tf.where(self._valid(), result, 0.0)
+
+    def rmatvec(self, coef: tf.Tensor, nrows=None) -> tf.Tensor:
+        def _rmatvec(coef, nrows, writes):
+            result = np.zeros(self.values.shape[1], dtype=np.float32)
+            for rows, chunk in self._chunks(nrows):
+                result += coef[rows] @ chunk
+            return result
+
+        if self.quantized:
+            coef = coef * self.scales
+        coef = tf.where(self._valid(), coef, 0.0)
+        args = [coef, self._nrows_arg(nrows), self.writes]
+        result = tf.numpy_function(_rmatvec, args, tf.float32)
+        return tf.ensure_shape(result, [self.values.shape[1]])
+
+    def matmul(self, vectors: tf.Tensor, nrows=None) -> tf.Tensor:
+        def _matmul(vectors, nrows, writes):
+            result = np.zeros((vectors.shape[0], self.nrow), dtype=np.float32)
+            for rows, chunk in self._chunks(nrows):
+                result[:, rows] = vectors @ chunk.T
+            return result
+
+        args = [vectors, self._nrows_arg(nrows), self.writes]
+        result = tf.numpy_function(_matmul, args, tf.float32)
+        result = tf.ensure_shape(result, [vectors.shape[0], self.nrow])
+        if self.quantized:
+            result = result * self.scales
+        return tf.where(self._valid(), result, 0.0)
+
+    def rmatmul(self, coefs: tf.Tensor, nrows=None) -> tf.Tensor:
+        def _rmatmul(coefs, nrows, writes):
+            result = np.zeros((coefs.shape[0], self.values.shape[1]), dtype=np.float32)
+            for rows, chunk in self._chunks(nrows):
+                result += coefs[:, rows] @ chunk
+            return result
+
+        if self.quantized:
+            coefs = coefs * self.scales
+        coefs = tf.where(self._valid(), coefs, 0.0)
+        args = [coefs, self._nrows_arg(nrows), self.writes]
+        result = tf.numpy_function(_rmatmul, args, tf.float32)
+        return tf.ensure_shape(result, [coefs.shape[0], self.values.shape[1]])
+
+    def gram_matrix(self, nrows=None) -> tf.Tensor:
+        valid = self._valid()
+        both = tf.logical_and(valid[:, None], valid[None, :])
+        if self.track_gram:
+            return tf.where(both, self.gram, 0.0)
+
+        def _gram(nrows, writes):
+            gram = np.zeros((self.nrow, self.nrow), dtype=np.float32)
+            for rows_a, chunk_a in self._chunks(nrows):
+                for rows_b, chunk_b in self._chunks(nrows):
+                    gram[rows_a, rows_b] = chunk_a @ chunk_b.T
+            return gram
+
+        gram = tf.numpy_function(_gram, [self._nrows_arg(nrows), self.writes], tf.float32)
+        gram = tf.ensure_shape(gram, [self.nrow, self.nrow])
+        if self.quantized:
+            gram = gram * tf.tensordot(self.scales, self.scales, axes=0)
+        return tf.where(both, gram, 0.0)
+
+    def _clear(self):
+        self.values[:] = 0
+        self.values.flush()
+        self.file_stamps[:] = 0
+        self.stamps.assign(tf.zeros_like(self.stamps))
+
+
+class ReplicaShardedMatrixFifo(RowWiseMatrixFifo):
+    """Circular fifo queue sharded along the columns over the replicas of a strategy.
+
+    Replica r keeps columns [r * shard_size, (r + 1) * shard_size) of the
+    zero padded matrix, so the memory per replica shrinks with the number of
+    replicas. The variables have to be replica-local (see
+    ``replica_local_variables``) and all methods run in replica context. Full
+    length vectors are sliced to the local columns, products summing over the
+    columns are all-reduced and products giving columns are all-gathered.
+
+    The Gram matrix is always tracked, recomputing it would need collectives
+    inside the conditional setup of D and B, which MirroredStrategy does not
+    allow. Distributed variables have no scatter updates, rows are written by
+    assigning the updated matrix.
+    """
 
+    def __init__(self, m, num_replicas, dtype="float32", tile_size=None):
+        super().__init__(m, circular=True, track_gram=True, dtype=dtype, tile_size=tile_size)
+        self.num_replicas = num_replicas
+        self.global_ncol = None
+        self.shard_size = None
+
+    def build(self, ncol: int, add_variable=None):
+        if self.values is not None:
+            return
+        self.global_ncol = ncol
+        self.shard_size = -(-ncol // self.num_replicas)
+        super().build(self.shard_size, add_variable)
+
+    def _scatter(self, variable: tf.Variable, indices: tf.Tensor, updates: tf.Tensor):
+        variable.assign(tf.tensor_scatter_nd_update(variable, indices, updates))
+
+    def _local(self, vectors: tf.Tensor) -> tf.Tensor:
+        """Slice the columns of this replica from vectors along the last axis."""
+        context = tf.distribute.get_replica_context()
+        start = tf.cast(context.replica_id_in_sync_group, tf.int32) * self.shard_size
+        padding = self.num_replicas * self.shard_size - self.global_ncol
+        axis = vectors.shape.rank - 1
+        vectors = tf.pad(vectors, [[0, 0]] * axis + [[0, padding]])
+        return tf.gather(vectors, start + tf.range(self.shard_size), axis=axis)
+
+    def _read_tile(self, tile: int) -> tf.Tensor:
+        # distributed variables have no sparse_read, the copy of this replica has
+        return self.values._get_on_device_or_primary().sparse_read(tile)
+
+    def _sum(self, value: tf.Tensor) -> tf.Tensor:
+        return tf.distribute.get_replica_context().all_reduce(tf.distribute.ReduceOp.SUM, value)
+
+    def _gather(self, local: tf.Tensor) -> tf.Tensor:
+        """Concatenate the local columns of all replicas and drop the padding."""
+        axis = local.shape.rank - 1
+        gathered = tf.distribute.get_replica_context().all_gather(local, axis=axis)
+        return gathered[..., : self.global_ncol]
 
-# def deflatten(
-#    flattened_grads: tf.Variable, shapes_grads: List[tf.shape]
-# ) -> tuple[tf.Variable]:  # noqa E501
-#    """Deflatten a tensorflow vector.#
-#
-#    Args:
-#        flattened_grads: flattened gradients.
-#        shape_grads: shape in which to reshape#
-#
-#    Return:
-#        tuple of tf.Variables
-#    """
-#    shapes_total = list(map(lambda x: tf.reduce_prod(x), shapes_grads))
-#    intermediate = tf.split(flattened_grads, shapes_total, axis=0)  # noqa E501
-#    deflattened = [
-#        tf.reshape(grad, shape) for grad, shape in zip(intermediate, shapes_grads)
-#    ]  # noqa E501
-#    return deflattened
+    def append(self, vector: tf.Tensor):
+        if self.values is None:
+            self.build(vector.shape[0])
+        super().append(self._local(vector))
+
+    def _row_products(self, row: tf.Tensor) -> tf.Tensor:
+        return self._sum(super().matvec(row))
+
+    def matvec(self, vector: tf.Tensor, nrows=None) -> tf.Tensor:
+        return self._sum(super().matvec(self._local(vector), nrows))
+
+    def rmatvec(self, coef: tf.Tensor, nrows=None) -> tf.Tensor:
+        return self._gather(super().rmatvec(coef, nrows))
+
+    def matmul(self, vectors: tf.Tensor, nrows=None) -> tf.Tensor:
+        return self._sum(super().matmul(self._local(vectors), nrows))
+
+    def rmatmul(self, coefs: tf.Tensor, nrows=None) -> tf.Tensor:
+        return self._gather(super().rmatmul(coefs, nrows))
+
+
+def new_variable(shape, dtype=tf.float32, initializer="zeros", name=None) -> tf.Variable:
+    """Create a non-trainable variable like `Optimizer.add_variable`."""
+    initial_value = tf.keras.initializers.get(initializer)(shape, dtype=dtype)
+    return tf.Variable(initial_value, trainable=False, name=name)
+
+
+@contextlib.contextmanager
+def replica_local_variables():
+    """Create variables in this context with one independent copy per replica.
+
+    The variables are synchronized on read, i.e. every replica reads and
+    writes its own copy, and reads outside of replica context give the copy
+    of the first replica.
+    """
+
+    def creator(next_creator, **kwargs):
+        kwargs["synchronization"] = tf.VariableSynchronization.ON_READ
+        kwargs["aggregation"] = tf.VariableAggregation.ONLY_FIRST_REPLICA
+        return next_creator(**kwargs)
+
+    with tf.variable_creator_scope(creator):
+        yield
+
+
+class ReplicaLocalCheckpoint(tf.__internal__.tracking.Trackable):
+    """Checkpoint every replica's copy of a replica-local variable.
+
+    A checkpoint of a variable created in ``replica_local_variables`` holds
+    only the copy of the first replica, which a restore writes to all copies.
+    Tracked instead of the variable, this saves one tensor per replica and
+    restores each into its own copy.
+    """
+
+    def __init__(self, variable):
+        self.variable = variable
+
+    def _serialize_to_tensors(self):
+        return {
+            f"replica_{replica}": copy.read_value()
+            for replica, copy in enumerate(self.variable.values)
+        }
+
+    def _restore_from_tensors(self, restored_tensors):
+        return tf.group(
+            [
+                copy.assign(restored_tensors[f"replica_{replica}"])
+                for replica, copy in enumerate(self.variable.values)
+            ]
+        )
+
+
+class FlatView:
+    """Layout of a list of tensors in one flat vector.
+
+    Sizes and offsets are computed once from the shapes. Flattening is a
+    single concat, which copies every element once into a new vector.
+    Unflattening splits that vector along its only axis and reshapes the
+    parts.
+    """
+
+    def __init__(self, shapes: List[tf.TensorShape]):
+        self.shapes = [tf.TensorShape(shape) for shape in shapes]
+        self.sizes = [shape.num_elements() for shape in self.shapes]
+        self.offsets = list(itertools.accumulate([0] + self.sizes[:-1]))
+        self.size = sum(self.sizes)
+
+    def flatten(self, tensors: List[tf.Tensor]) -> tf.Tensor:
+        """Write tensors into one flat vector.
+
+        Args:
+            tensors: list of tensors with the shapes of the view.
+
+        Returns:
+            one-dimensional tensor of length size.
+        """
+        return tf.concat([tf.reshape(tensor, [-1]) for tensor in tensors], axis=0)
+
+    def unflatten(self, flat: tf.Tensor) -> List[tf.Tensor]:
+        """Split a flat vector into tensors with the shapes of the view.
+
+        Args:
+            flat: one-dimensional tensor of length size.
+
+        Returns:
+            list of tensors.
+        """
+        parts = tf.split(flat, self.sizes, axis=0)
+        return [tf.reshape(part, shape) for part, shape in zip(parts, self.shapes)]
+
+    def flatten_batch(self, tensors: List[tf.Tensor]) -> tf.Tensor:
+        """Write batches of tensors into one matrix with a flat vector per row.
+
+        Args:
+            tensors: list of tensors with a leading batch axis followed by the
+                shapes of the view.
+
+        Returns:
+            two-dimensional tensor of batch size by size.
+        """
+        batch = tf.shape(tensors[0])[0]
+        return tf.concat([tf.reshape(tensor, [batch, -1]) for tensor in tensors], axis=1)
+
+    def unflatten_batch(self, flat: tf.Tensor) -> List[tf.Tensor]:
+        """Split a matrix of flat vectors into batches of tensors.
+
+        Args:
+            flat: two-dimensional tensor of batch size by size.
+
+        Returns:
+            list of tensors with a leading batch axis followed by the shapes of
+            the view.
+        """
+        parts = tf.split(flat, self.sizes, axis=1)
+        batch = tf.shape(flat)[0]
+        return [
+            tf.reshape(part, tf.concat([[batch], shape], axis=0))
+            for part, shape in zip(parts, self.shapes)
+        ]
+
+
+class GradientBlock:
+    """Group of model variables that is preconditioned on its own.
+
+    Every block has its own ``hessian``, an InverseHessianApproximator with a
+    fifo-que of flattened gradients, which the optimizer allocates in ``build``.
+    Blocks with ``m`` set to None are not preconditioned and get the plain
+    gradient. ``view`` lays the gradients of the block out in one flat vector.
+    """
+
+    def __init__(self, name: str, indices: List[int], view: "FlatView", m=None):
+        self.name = name
+        self.indices = indices
+        self.view = view
+        self.size = view.size
+        self.m = m
+        self.hessian = None
+
+
+def group_variables(var_list, block_by=None) -> dict:
+    """Group the positions of variables into blocks.
+
+    Args:
+        var_list: list of model variables.
+        block_by: None for one block with all variables, "layer" to group the
+            variables by the layer they belong to or "variable" for one block
+            per variable.
+
+    Returns:
+        dictionary from block name to list of positions in var_list.
+
+    Raises:
+        ValueError: if block_by is unknown.
+    """
+    groups: dict = {}
+    for idx, var in enumerate(var_list):
+        name = var.name.split(":")[0]
+        if block_by is None:
+            key = "all"
+        elif block_by == "layer":
+            key = name.rsplit("/", 1)[0]
+        elif block_by == "variable":
+            key = name
+        else:
+            raise ValueError(f"Unknown block_by '{block_by}'.")
+        groups.setdefault(key, []).append(idx)
+    return groups
 
 
 def write_results_to_plot(csv_file: str, destination_file: str) -> None:
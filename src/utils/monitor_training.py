@@ -1,17 +1,27 @@
 """Callbacks, loggers, profilers etc. to track experiment results."""
+
 import csv
 import time
+from pathlib import Path
 
+import numpy as np
 import tensorflow as tf
 
+from src.optimizers.F_MFAC import PROFILED_PHASES
+
 
 class CustomCSVLogger(tf.keras.callbacks.Callback):
-    def __init__(self, filename):
+    def __init__(self, filename, append=False):
         super(CustomCSVLogger, self).__init__()
         self.filename = filename
-        self.csv_file = open(filename, mode="w", newline="")
+        # a resumed run continues the rows of an existing log
+        append = append and Path(filename).is_file() and Path(filename).stat().st_size > 0
+        self.csv_file = open(filename, mode="a" if append else "w", newline="")
         self.csv_writer = csv.writer(self.csv_file)
-        self.csv_writer.writerow(["epoch", "time", "loss", "accuracy", "val_loss", "val_accuracy"])
+        if not append:
+            self.csv_writer.writerow(
+                ["epoch", "time", "loss", "accuracy", "val_loss", "val_accuracy"]
+            )
 
     def on_epoch_begin(self, epoch, logs=None):
         self.start_time = time.time()
@@ -32,3 +42,120 @@ class CustomCSVLogger(tf.keras.callbacks.Callback):
 
     def on_train_end(self, logs=None):
         self.csv_file.close()
+
+
+class HistorySizeScheduler(tf.keras.callbacks.Callback):
+    """Shrink the history of an MFAC optimizer while it does not slow training down.
+
+    The progress of an epoch is its loss decrease per second of a training step.
+    Loss curves flatten, so a halved history is judged against the decrease the
+    trend of the epochs before predicts: a line through the logarithms of their
+    last `window` decreases. The history is halved, down to `min_m`, as long as
+    the progress does not drop by more than `tolerance` below the predicted
+    decrease at the step time before the halving. Otherwise the last halving is
+    undone and the size is kept. The history only grows for that undo, and it
+    keeps preconditioning with the gradients it kept while it refills. The
+    optimizer needs `resizable_history=True`.
+    """
+
+    def __init__(self, min_m, tolerance=0.2, window=3):
+        super(HistorySizeScheduler, self).__init__()
+        if window < 2:
+            raise ValueError("`window` must be at least 2.")
+        self.min_m = min_m
+        self.tolerance = tolerance
+        self.window = window
+        self.size = None
+        self.previous_size = None
+        self.settled = False
+        self.shrunk = False
+        self.losses = []
+        self.step_seconds = []
+
+    def on_train_begin(self, logs=None):
+        self.size = self.model.optimizer.m
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start_time = time.perf_counter()
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.step_seconds.append((time.perf_counter() - self.start_time) / max(self.steps, 1))
+        self.losses.append(logs["loss"])
+        if self.settled or len(self.losses) < 3:
+            return
+        decreases = -np.diff(self.losses)
+        if self.shrunk:
+            # progress the larger history would have made at its step time
+            predicted = self._predict(decreases[:-1])
+            expected = None if predicted is None else predicted / self.step_seconds[-2]
+            progress = decreases[-1] / self.step_seconds[-1]
+            if expected is None or progress < (1 - self.tolerance) * expected:
+                self.settled = True
+                self._resize(self.previous_size)
+                return
+        self.shrunk = self.size // 2 >= self.min_m and self._predict(decreases) is not None
+        if self.shrunk:
+            self._resize(self.size // 2)
+        elif self.size // 2 < self.min_m:
+            self.settled = True
+
+    def _predict(self, decreases):
+        """Extrapolate the next loss decrease, None if the trend is not a decrease."""
+        decreases = decreases[-self.window :]
+        if len(decreases) < 2 or np.any(decreases <= 0):
+            return None
+        slope, intercept = np.polyfit(np.arange(len(decreases)), np.log(decreases), 1)
+        return float(np.exp(intercept + slope * len(decreases)))
+
+    def _resize(self, size):
+        self.previous_size, self.size = self.size, size
+        self.model.optimizer.set_history_size(size)
+
+
+class StepTimeProfiler(tf.keras.callbacks.Callback):
+    """Record the seconds of every training step and of its MFAC phases.
+
+    The phases in PROFILED_PHASES are read from `phase_seconds` of an MFAC
+    optimizer created with `profile=True`. The rest of a step, mainly the
+    forward and backward pass, is logged as forward_backward. Optimizers that
+    do not profile get NaN phases. The columns are written as arrays of one
+    compressed .npz file after every epoch.
+    """
+
+    def __init__(self, filename):
+        super(StepTimeProfiler, self).__init__()
+        self.filename = filename
+        self.columns = {
+            name: [] for name in ("epoch", "step", "time", "forward_backward") + PROFILED_PHASES
+        }
+        self.epoch = 0
+        self.last_phases = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.start_time = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        phase_seconds = getattr(self.model.optimizer, "phase_seconds", None)
+        if phase_seconds is None:
+            phases = np.full(len(PROFILED_PHASES), np.nan)
+        else:
+            # the optimizer adds up the seconds over all steps
+            total = phase_seconds.numpy()
+            phases = total - (self.last_phases if self.last_phases is not None else 0)
+            self.last_phases = total
+        elapsed_time = time.perf_counter() - self.start_time
+        row = [self.epoch, batch, elapsed_time, elapsed_time - phases.sum()] + list(phases)
+        for column, value in zip(self.columns.values(), row):
+            column.append(value)
+
+    def on_epoch_end(self, epoch, logs=None):
+        np.savez_compressed(
+            self.filename, **{name: np.asarray(values) for name, values in self.columns.items()}
+        )
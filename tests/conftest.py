@@ -0,0 +1,9 @@
+"""Pytest configuration shared by all tests."""
+
+import tensorflow as tf
+
+# two logical cpus, so tf.distribute strategies can be tested on one cpu
+_cpu = tf.config.list_physical_devices("CPU")[0]
+tf.config.set_logical_device_configuration(
+    _cpu, [tf.config.LogicalDeviceConfiguration(), tf.config.LogicalDeviceConfiguration()]
+)
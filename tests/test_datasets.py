@@ -0,0 +1,106 @@
+"""Tests for :mod:`src.utils.datasets`."""
+
+import random
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from src.utils.datasets import _initial_weights, cached_arrays, get_model, stream_arrays
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_stream_arrays_shuffles_deterministically(tmp_path, cached):
+    """Every example once per epoch, in an order that only depends on the seed."""
+    x = np.arange(10 * 2 * 2, dtype=np.uint8).reshape(10, 2, 2)
+    y = np.arange(10)
+    cache_file = str(tmp_path / "cache") if cached else None
+
+    def epochs(dataset):
+        return [
+            np.concatenate([labels for _, labels in dataset.as_numpy_iterator()]) for _ in range(2)
+        ]
+
+    dataset = stream_arrays(x, y, batch_size=4, seed=3, cache_file=cache_file)
+    first, second = epochs(dataset)
+    np.testing.assert_array_equal(np.sort(first), y)
+    assert not np.array_equal(first, second)
+    again = epochs(stream_arrays(x, y, batch_size=4, seed=3, cache_file=cache_file))
+    np.testing.assert_array_equal(again[0], first)
+    np.testing.assert_array_equal(again[1], second)
+    images, labels = next(iter(dataset))
+    assert images.dtype.name == "float32" and images.shape == (4, 2, 2)
+    np.testing.assert_allclose(images.numpy(), x[labels.numpy()] / 255.0, rtol=1e-6)
+    ordered = stream_arrays(x, y, batch_size=4)
+    np.testing.assert_array_equal(epochs(ordered)[0], y)
+
+
+def test_stream_arrays_publishes_complete_cache(tmp_path):
+    """Pipelines iterated side by side read one complete cache without a lockfile."""
+    x = np.arange(10 * 2, dtype=np.uint8).reshape(10, 2)
+    y = np.arange(10)
+    # a cache directory a killed run left behind
+    (tmp_path / ".cache-killed").mkdir()
+    (tmp_path / ".cache-killed" / "cache_0.lockfile").write_text("")
+    cache_file = str(tmp_path / "cache")
+    first = iter(stream_arrays(x, y, batch_size=4, cache_file=cache_file))
+    second = iter(stream_arrays(x, y, batch_size=4, cache_file=cache_file))
+    np.testing.assert_array_equal(next(first)[1], next(second)[1])
+    np.testing.assert_array_equal(np.concatenate([labels for _, labels in second]), y[4:])
+    assert sorted(path.name for path in (tmp_path / "cache").iterdir()) == [
+        "cache.data-00000-of-00001",
+        "cache.index",
+    ]
+
+
+def test_cached_arrays_builds_once(tmp_path):
+    """A cache hit memory-maps the stored arrays instead of building them again."""
+    calls = []
+
+    def build():
+        calls.append(1)
+        return np.arange(6, dtype=np.float32).reshape(2, 3), np.array([1, 2])
+
+    first = cached_arrays(tmp_path, {"dataset": "toy", "scale": 1}, build)
+    second = cached_arrays(tmp_path, {"scale": 1, "dataset": "toy"}, build)
+    assert len(calls) == 1
+    assert isinstance(second[0], np.memmap) and not second[0].flags.writeable
+    for stored, built in zip(second, build()):
+        np.testing.assert_array_equal(stored, built)
+    np.testing.assert_array_equal(first[1], second[1])
+    cached_arrays(tmp_path, {"dataset": "toy", "scale": 2}, build)
+    assert len(calls) == 3
+    assert len([path for path in tmp_path.iterdir() if not path.name.startswith(".")]) == 2
+
+
+def test_get_model_restores_initial_weights(tmp_path):
+    """Seeded models start from the same weights, snapshotted on disk."""
+    first = get_model("full_neural_network", 10, seed=0, cache_dir=tmp_path).get_weights()
+    model = get_model("full_neural_network", 10, seed=0, cache_dir=tmp_path)
+    model.set_weights([np.zeros_like(w) for w in first])
+    again = get_model("full_neural_network", 10, seed=0, cache_dir=tmp_path).get_weights()
+    other = get_model("full_neural_network", 10, seed=1, cache_dir=tmp_path).get_weights()
+    assert all(np.array_equal(a, b) for a, b in zip(first, again))
+    assert not all(np.array_equal(a, b) for a, b in zip(first, other))
+    assert len(list(tmp_path.glob("*.npz"))) == 2
+
+
+def test_get_model_keeps_random_state_and_strategy_models_apart():
+    """Initial weights neither depend on nor change the random state of the process."""
+    random.seed(0)
+    expected = random.random()
+    random.seed(0)
+    first = get_model("full_neural_network", 10, seed=5).get_weights()
+    assert random.random() == expected
+    _initial_weights.cache_clear()
+    random.seed(1)
+    again = get_model("full_neural_network", 10, seed=5).get_weights()
+    assert all(np.array_equal(a, b) for a, b in zip(first, again))
+    assert get_model("full_neural_network", 10, seed=5) is get_model(
+        "full_neural_network", 10, seed=5
+    )
+    with tf.distribute.MirroredStrategy(["/cpu:0", "/cpu:1"]).scope():
+        model = get_model("full_neural_network", 10, seed=5)
+        assert all(np.array_equal(a, b) for a, b in zip(first, model.get_weights()))
+    with tf.distribute.MirroredStrategy(["/cpu:0", "/cpu:1"]).scope():
+        assert get_model("full_neural_network", 10, seed=5) is not model
@@ -0,0 +1,223 @@
+"""Tests for :mod:`src.utils.helper_functions`."""
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from src.utils.helper_functions import (
+    FlatView,
+    MemmapMatrixFifo,
+    RowWiseMatrixFifo,
+)
+
+
+def test_circular_fifo_matches_shifting_fifo():
+    """Circular fifo read in logical order equals the shifting fifo."""
+    shifting = RowWiseMatrixFifo(3)
+    circular = RowWiseMatrixFifo(3, circular=True)
+    for step in range(7):
+        vector = tf.constant(np.full(4, step, dtype=np.float32))
+        shifting.append(vector)
+        circular.append(vector)
+        logical = tf.gather(circular.values, circular.order())
+        np.testing.assert_array_equal(logical.numpy(), shifting.values.numpy())
+    assert int(circular.counter) == int(shifting.counter) == 7
+
+
+def test_tracked_gram_matches_full_gram():
+    """Incrementally updated gram matrix equals values @ values^T."""
+    for circular in (False, True):
+        fifo = RowWiseMatrixFifo(3, circular=circular, track_gram=True)
+        rng = np.random.default_rng(0)
+        for _ in range(5):
+            fifo.append(tf.constant(rng.normal(size=6).astype(np.float32)))
+            full = tf.linalg.matmul(fifo.values, fifo.values, transpose_b=True)
+            np.testing.assert_allclose(fifo.gram_matrix().numpy(), full.numpy(), rtol=1e-5)
+
+
+def test_reduced_precision_fifo_products():
+    """Products of low precision fifos match float32 ones up to rounding."""
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(5, 64)).astype(np.float32)
+    vec = tf.constant(rng.normal(size=64).astype(np.float32))
+    reference = RowWiseMatrixFifo(3, circular=True)
+    for vector in vectors:
+        reference.append(tf.constant(vector))
+    for dtype in ("float16", "bfloat16", "int8"):
+        fifo = RowWiseMatrixFifo(3, circular=True, track_gram=True, dtype=dtype)
+        for vector in vectors:
+            fifo.append(tf.constant(vector))
+        assert fifo.values.dtype == tf.as_dtype(dtype)
+        np.testing.assert_allclose(
+            fifo.matvec(vec).numpy(), reference.matvec(vec).numpy(), rtol=0.05, atol=0.3
+        )
+        np.testing.assert_allclose(
+            fifo.gram_matrix().numpy(), reference.gram_matrix().numpy(), rtol=0.05, atol=0.3
+        )
+
+
+def test_memmap_fifo_matches_in_memory_fifo(tmp_path):
+    """Disk backed fifo gives the same products as the in-memory one."""
+    rng = np.random.default_rng(0)
+    in_memory = RowWiseMatrixFifo(5, circular=True, track_gram=True)
+    on_disk = MemmapMatrixFifo(5, tmp_path / "fifo.dat", track_gram=False, chunk_rows=2)
+    for _ in range(7):
+        vector = tf.constant(rng.normal(size=11).astype(np.float32))
+        in_memory.append(vector)
+        on_disk.append(vector)
+    vec = tf.constant(rng.normal(size=11).astype(np.float32))
+    coef = tf.constant(rng.normal(size=5).astype(np.float32))
+    np.testing.assert_allclose(
+        on_disk.matvec(vec).numpy(), in_memory.matvec(vec).numpy(), rtol=1e-5
+    )
+    np.testing.assert_allclose(
+        on_disk.rmatvec(coef).numpy(), in_memory.rmatvec(coef).numpy(), rtol=1e-5
+    )
+    np.testing.assert_allclose(
+        on_disk.gram_matrix().numpy(), in_memory.gram_matrix().numpy(), rtol=1e-5
+    )
+    assert (tmp_path / "fifo.dat").stat().st_size == 5 * 11 * 4
+
+
+def test_tiled_fifo_products():
+    """Walking the columns in tiles gives the same products."""
+    rng = np.random.default_rng(0)
+    whole = RowWiseMatrixFifo(4, circular=True)
+    tiled = RowWiseMatrixFifo(4, circular=True, dtype="bfloat16", tile_size=3)
+    for _ in range(6):
+        vector = tf.constant(rng.normal(size=10).astype(np.float32))
+        whole.append(tf.cast(tf.cast(vector, tf.bfloat16), tf.float32))
+        tiled.append(vector)
+    vec = tf.constant(rng.normal(size=10).astype(np.float32))
+    coef = tf.constant(rng.normal(size=4).astype(np.float32))
+    np.testing.assert_allclose(tiled.matvec(vec).numpy(), whole.matvec(vec).numpy(), rtol=1e-5)
+    np.testing.assert_allclose(tiled.rmatvec(coef).numpy(), whole.rmatvec(coef).numpy(), rtol=1e-5)
+    np.testing.assert_allclose(tiled.gram_matrix().numpy(), whole.gram_matrix().numpy(), rtol=1e-5)
+
+
+def test_tiled_fifo_reads_one_tile_at_a_time():
+    """No tensor of the tiled products holds the whole matrix, only single tiles."""
+    m, ncol, tile_size = 4, 50, 3
+    fifo = RowWiseMatrixFifo(m, circular=True, tile_size=tile_size)
+    fifo.build(ncol)
+    assert fifo.values.shape == (17, m, tile_size)
+    vector = tf.ones([ncol])
+    vectors = tf.ones([2, ncol])
+    products = [
+        lambda: fifo.matvec(vector),
+        lambda: fifo.rmatvec(tf.ones([m])),
+        lambda: fifo.matmul(vectors, 3),
+        lambda: fifo.rmatmul(tf.ones([2, m])),
+        lambda: fifo.gram_matrix(),
+    ]
+    for product in products:
+        graph = tf.function(product).get_concrete_function().graph
+        sizes = [
+            output.shape.num_elements()
+            for op in graph.get_operations()
+            for output in op.outputs
+            if output.shape.is_fully_defined()
+        ]
+        assert max(sizes) < m * ncol
+        assert "ReadVariableOp" not in {op.type for op in graph.get_operations()}
+
+
+@pytest.mark.parametrize("dtype", ["bfloat16", "int8"])
+def test_low_precision_fifo_dequantizes_one_tile_at_a_time(dtype):
+    """No float32 copy of the whole matrix is made, the products stay the same."""
+    m, ncol = 4, 50
+    rng = np.random.default_rng(2)
+    fifo = RowWiseMatrixFifo(m, circular=True, track_gram=True, dtype=dtype)
+    fifo.dequantized_tile_size = 16
+    whole = RowWiseMatrixFifo(m, circular=True, track_gram=True, dtype=dtype)
+    whole.dequantized_tile_size = None
+    for vector in rng.normal(size=(m + 1, ncol)).astype(np.float32):
+        fifo.append(tf.constant(vector))
+        whole.append(tf.constant(vector))
+    assert fifo.values.shape == (4, m, 16) and whole.values.shape == (m, ncol)
+    vector = tf.constant(rng.normal(size=ncol).astype(np.float32))
+    np.testing.assert_allclose(fifo.matvec(vector), whole.matvec(vector), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(fifo.rmatvec(tf.ones([m])), whole.rmatvec(tf.ones([m])), rtol=1e-5)
+    for product in (
+        lambda: fifo.matvec(vector),
+        lambda: fifo.rmatvec(tf.ones([m])),
+        lambda: fifo.matmul(tf.ones([2, ncol])),
+    ):
+        graph = tf.function(product).get_concrete_function().graph
+        sizes = [
+            output.shape.num_elements()
+            for op in graph.get_operations()
+            for output in op.outputs
+            if output.dtype == tf.float32 and output.shape.is_fully_defined()
+        ]
+        assert max(sizes) < m * ncol
+
+
+@pytest.mark.parametrize("fifo_class", [RowWiseMatrixFifo, "tiled", "memmap"])
+def test_resized_fifo_keeps_newest_vectors(tmp_path, fifo_class):
+    """Shrinking and growing the ring keeps the newest vectors in the leading slots."""
+    if fifo_class is RowWiseMatrixFifo:
+        fifo = RowWiseMatrixFifo(5, circular=True, track_gram=True, dtype="int8")
+    elif fifo_class == "tiled":
+        fifo = RowWiseMatrixFifo(5, circular=True, track_gram=True, tile_size=4)
+    else:
+        fifo = MemmapMatrixFifo(5, tmp_path / "fifo.dat")
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(11, 6)).astype(np.float32)
+    for vector in vectors[:7]:
+        fifo.append(tf.constant(vector))
+    fifo.resize(3)
+    for vector in vectors[7:9]:
+        fifo.append(tf.constant(vector))
+    fifo.resize(5)
+    for vector in vectors[9:]:
+        fifo.append(tf.constant(vector))
+    # the 3 newest before growing and the 2 appended after
+    expected = vectors[:5:-1]
+    assert int(fifo.counter) == 5
+    np.testing.assert_allclose(
+        fifo.rmatmul(tf.gather(tf.eye(5), fifo.order(), axis=1)), expected, atol=0.05
+    )
+    dense = fifo.rmatmul(tf.eye(5)).numpy()
+    np.testing.assert_allclose(fifo.gram_matrix().numpy(), dense @ dense.T, rtol=1e-4, atol=1e-4)
+    fifo.resize(2)
+    np.testing.assert_allclose(fifo.rmatmul(tf.eye(5))[2:].numpy(), 0.0)
+
+
+@pytest.mark.parametrize("nrows", [None, 3])
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_batched_products_match_vector_products(tmp_path, on_disk, nrows):
+    """matmul and rmatmul stack the products of single vectors."""
+    rng = np.random.default_rng(0)
+    if on_disk:
+        fifo = MemmapMatrixFifo(5, tmp_path / "fifo.dat", dtype="int8", chunk_rows=2)
+    else:
+        fifo = RowWiseMatrixFifo(5, circular=True, dtype="int8", tile_size=4)
+    for _ in range(3 if nrows else 7):
+        fifo.append(tf.constant(rng.normal(size=11).astype(np.float32)))
+    vectors = tf.constant(rng.normal(size=(3, 11)).astype(np.float32))
+    coefs = tf.constant(rng.normal(size=(3, 5)).astype(np.float32))
+    products = fifo.matmul(vectors, nrows).numpy()
+    rproducts = fifo.rmatmul(coefs, nrows).numpy()
+    for i in range(3):
+        expected = fifo.matvec(vectors[i], nrows).numpy()
+        np.testing.assert_allclose(products[i], expected, rtol=1e-5)
+        expected = fifo.rmatvec(coefs[i], nrows).numpy()
+        np.testing.assert_allclose(rproducts[i], expected, rtol=1e-5, atol=1e-6)
+
+
+def test_flat_view_round_trip():
+    """Flattening and unflattening restores the tensors."""
+    tensors = [tf.reshape(tf.range(6.0), (2, 3)), tf.constant([7.0]), tf.ones((2, 1, 2))]
+    view = FlatView([tensor.shape for tensor in tensors])
+    assert view.sizes == [6, 1, 4]
+    assert view.offsets == [0, 6, 7]
+    flat = view.flatten(tensors)
+    assert flat.shape == (view.size,)
+    for restored, tensor in zip(view.unflatten(flat), tensors):
+        np.testing.assert_array_equal(restored.numpy(), tensor.numpy())
+    batch = [tf.stack([tensor, 2 * tensor]) for tensor in tensors]
+    flat = view.flatten_batch(batch)
+    assert flat.shape == (2, view.size)
+    for restored, tensor in zip(view.unflatten_batch(flat), batch):
+        np.testing.assert_array_equal(restored.numpy(), tensor.numpy())
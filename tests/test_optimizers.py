@@ -0,0 +1,477 @@
+"""Tests for :mod:`src.optimizers`."""
+
+import itertools
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from src.optimizers.F_MFAC import PROFILED_PHASES, with_mfac
+from src.optimizers.F_MFAC_ADAM import Adam_Mfac
+from src.optimizers.F_MFAC_SGD import Mfac
+from src.optimizers.InverseHessianApproximator import InverseHessianApproximator
+from src.optimizers.MFAC import MFAC
+from src.utils.monitor_training import HistorySizeScheduler, StepTimeProfiler
+
+M = 4
+DAMP = 0.1
+
+
+def _dense_inverse_hessian_product(history, vec, damp=DAMP):
+    """Solve (1 / damp * I + G^T G / m) x = vec densely."""
+    m, d = history.shape
+    hessian = np.eye(d) / damp + history.T @ history / m
+    return np.linalg.solve(hessian, vec)
+
+
+@pytest.mark.parametrize("optimizer_class", [MFAC, Mfac, Adam_Mfac])
+def test_inverse_hessian_product_matches_dense_solve(optimizer_class):
+    """Algorithm 1 and 2 give the inverse of the damped empirical fisher."""
+    optimizer = optimizer_class(m=M, damp=DAMP)
+    optimizer.build([tf.Variable(tf.zeros(9))])
+    block = optimizer.blocks[0]
+    rng = np.random.default_rng(0)
+    grads = rng.normal(size=(M + 2, 9)).astype(np.float32)
+    for grad in grads:
+        block.hessian.GradFifo.append(tf.constant(grad))
+    block.hessian._setupMatrices()
+    vec = rng.normal(size=9).astype(np.float32)
+    result = block.hessian._compute_InvMatVec(tf.constant(vec))
+    expected = _dense_inverse_hessian_product(grads[-M:].astype(np.float64), vec)
+    np.testing.assert_allclose(result.numpy(), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_refresh_interval_reuses_factorization():
+    """D and B are only set up every refresh_interval steps."""
+    optimizer = MFAC(m=M, damp=DAMP, refresh_interval=3)
+    optimizer.build([tf.Variable(tf.zeros(9))])
+    block = optimizer.blocks[0]
+    rng = np.random.default_rng(0)
+    staleness = []
+    for _ in range(M + 5):
+        optimizer._scale_flat_grad(block, tf.constant(rng.normal(size=9).astype(np.float32)))
+        staleness.append(int(block.hessian.staleness))
+    assert staleness[M - 1 :] == [0, 1, 2, 0, 1, 2]
+
+
+def test_layerwise_blocks_are_preconditioned_independently():
+    """Every layer gets its own fifo, small layers keep the plain gradient."""
+    kernel = tf.Variable(tf.zeros((3, 2)), name="dense/kernel")
+    bias = tf.Variable(tf.zeros(2), name="dense/bias")
+    gamma = tf.Variable(tf.ones(2), name="batch_normalization/gamma")
+    optimizer = Mfac(m=M, damp=DAMP, block_by="layer", min_block_size=4)
+    optimizer.build([kernel, bias, gamma])
+    assert [(block.name, block.size, block.m) for block in optimizer.blocks] == [
+        ("dense", 8, M),
+        ("batch_normalization", 2, None),
+    ]
+    rng = np.random.default_rng(0)
+    history = []
+    for _ in range(M):
+        grads = [
+            tf.constant(rng.normal(size=var.shape).astype(np.float32))
+            for var in (kernel, bias, gamma)
+        ]
+        history.append(np.concatenate([grads[0].numpy().ravel(), grads[1].numpy()]))
+        scaled = optimizer._scale_grads(grads)
+    expected = _dense_inverse_hessian_product(np.array(history, dtype=np.float64), history[-1])
+    np.testing.assert_allclose(scaled[0].numpy().ravel(), expected[:6], rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(scaled[1].numpy(), expected[6:], rtol=1e-4, atol=1e-5)
+    np.testing.assert_array_equal(scaled[2].numpy(), grads[2].numpy())
+
+
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_warm_start_uses_stored_gradients_only(jit_compile):
+    """Before the fifo is full the preconditioner is built from the stored gradients."""
+    optimizer = MFAC(m=M, damp=DAMP, warm_start=2)
+    optimizer.jit_compile = jit_compile
+    optimizer.build([tf.Variable(tf.zeros(9))])
+    block = optimizer.blocks[0]
+    rng = np.random.default_rng(0)
+    grads = rng.normal(size=(M, 9)).astype(np.float32)
+    scaled = optimizer._scale_flat_grad(block, tf.constant(grads[0]))
+    np.testing.assert_array_equal(scaled.numpy(), grads[0])
+    for count in range(2, M + 1):
+        scaled = optimizer._scale_flat_grad(block, tf.constant(grads[count - 1]))
+        expected = _dense_inverse_hessian_product(
+            grads[:count].astype(np.float64), grads[count - 1]
+        )
+        np.testing.assert_allclose(scaled.numpy(), expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("history_dtype", ["bfloat16", "int8"])
+def test_reduced_precision_history(history_dtype):
+    """Low precision storage of the history keeps the product close."""
+    optimizer = MFAC(m=M, damp=DAMP, history_dtype=history_dtype)
+    optimizer.build([tf.Variable(tf.zeros(32))])
+    block = optimizer.blocks[0]
+    rng = np.random.default_rng(0)
+    grads = rng.normal(size=(M, 32)).astype(np.float32)
+    for grad in grads:
+        block.hessian.GradFifo.append(tf.constant(grad))
+    block.hessian._setupMatrices()
+    vec = rng.normal(size=32).astype(np.float32)
+    result = block.hessian._compute_InvMatVec(tf.constant(vec))
+    expected = _dense_inverse_hessian_product(grads.astype(np.float64), vec)
+    np.testing.assert_allclose(result.numpy(), expected, rtol=0.05, atol=0.01)
+
+
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_resized_history_uses_newest_gradients(jit_compile):
+    """After a resize the product is that of the newest gradients that are kept."""
+    hessian = InverseHessianApproximator(M, DAMP, resizable=True, jit_compile=jit_compile)
+    rng = np.random.default_rng(8)
+    grads = rng.normal(size=(M + 3, 9)).astype(np.float32)
+    vec = rng.normal(size=9).astype(np.float32)
+    for grad in grads[: M + 1]:
+        hessian.update(tf.constant(grad))
+    hessian.resize(2)
+    expected = _dense_inverse_hessian_product(grads[M - 1 : M + 1].astype(np.float64), vec)
+    np.testing.assert_allclose(hessian.apply(vec).numpy(), expected, rtol=1e-4, atol=1e-5)
+    hessian.resize(M)
+    hessian.update(tf.constant(grads[M + 1]))
+    # the grown history is used while it refills
+    expected = _dense_inverse_hessian_product(grads[M - 1 : M + 2].astype(np.float64), vec)
+    np.testing.assert_allclose(hessian.apply(vec).numpy(), expected, rtol=1e-4, atol=1e-5)
+    hessian.update(tf.constant(grads[M + 2]))
+    expected = _dense_inverse_hessian_product(grads[-M:].astype(np.float64), vec)
+    np.testing.assert_allclose(hessian.apply(vec).numpy(), expected, rtol=1e-4, atol=1e-5)
+    with pytest.raises(ValueError):
+        InverseHessianApproximator(M, DAMP).resize(2)
+
+
+def test_damping_adapts_to_target():
+    """The damping moves towards the target and the product uses the current one."""
+    hessian = InverseHessianApproximator(M, DAMP, damping_target=1.0)
+    rng = np.random.default_rng(9)
+    grads = rng.normal(size=(M + 20, 9)).astype(np.float32)
+    for grad in grads:
+        hessian.update(tf.constant(grad))
+    damping = float(hessian.damping.numpy())
+    assert damping > DAMP
+    measure = np.diag(hessian.D.numpy()).sum() / M**2
+    assert 0.5 < measure < 2.0
+    vec = rng.normal(size=9).astype(np.float32)
+    expected = _dense_inverse_hessian_product(grads[-M:].astype(np.float64), vec, damp=damping)
+    np.testing.assert_allclose(hessian.apply(vec).numpy(), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_memory_mapped_history(tmp_path):
+    """A memory-mapped history gives the same product as the in-memory one."""
+    optimizer = Mfac(m=M, damp=DAMP, history_path=tmp_path, history_chunk_rows=3)
+    optimizer.build([tf.Variable(tf.zeros(9))])
+    block = optimizer.blocks[0]
+    rng = np.random.default_rng(0)
+    grads = rng.normal(size=(M, 9)).astype(np.float32)
+    for grad in grads[:-1]:
+        optimizer._scale_flat_grad(block, tf.constant(grad))
+    result = optimizer._scale_flat_grad(block, tf.constant(grads[-1]))
+    expected = _dense_inverse_hessian_product(grads.astype(np.float64), grads[-1])
+    np.testing.assert_allclose(result.numpy(), expected, rtol=1e-4, atol=1e-5)
+    assert sorted(tmp_path.iterdir()) == [
+        tmp_path / "MFAC_all.dat",
+        tmp_path / "MFAC_all.dat.stamps",
+    ]
+
+
+@pytest.mark.parametrize("optimizer_class", [MFAC, Mfac, Adam_Mfac])
+def test_batched_inverse_hessian_product(optimizer_class):
+    """The batched product equals the product of every single vector."""
+    kernel = tf.Variable(tf.zeros((3, 2)), name="dense/kernel")
+    bias = tf.Variable(tf.zeros(2), name="dense/bias")
+    optimizer = optimizer_class(m=M, damp=DAMP, block_by="variable")
+    optimizer.build([kernel, bias])
+    rng = np.random.default_rng(0)
+    for _ in range(M + 1):
+        optimizer._scale_grads(
+            [tf.constant(rng.normal(size=var.shape).astype(np.float32)) for var in (kernel, bias)]
+        )
+    vectors = [
+        tf.constant(rng.normal(size=(5,) + var.shape).astype(np.float32)) for var in (kernel, bias)
+    ]
+    scaled = optimizer.inverse_hessian_product(vectors)
+    for block, idx in zip(optimizer.blocks, [0, 1]):
+        for i in range(5):
+            expected = block.hessian._compute_InvMatVec(tf.reshape(vectors[idx][i], [-1]))
+            np.testing.assert_allclose(
+                tf.reshape(scaled[idx][i], [-1]).numpy(), expected.numpy(), rtol=1e-4, atol=1e-6
+            )
+
+
+def test_standalone_inverse_hessian_approximator():
+    """The approximator works without an optimizer, e.g. for pruning."""
+    hessian = InverseHessianApproximator(M, DAMP)
+    rng = np.random.default_rng(0)
+    grads = rng.normal(size=(M + 1, 9)).astype(np.float32)
+    vectors = rng.normal(size=(3, 9)).astype(np.float32)
+    hessian.update(tf.constant(grads[0]))
+    np.testing.assert_array_equal(hessian.apply(tf.constant(vectors[0])).numpy(), vectors[0])
+    for grad in grads[1:]:
+        hessian.update(tf.constant(grad))
+    expected = _dense_inverse_hessian_product(grads[-M:].astype(np.float64), vectors.T).T
+    result = hessian.apply_batch(tf.constant(vectors))
+    np.testing.assert_allclose(result.numpy(), expected, rtol=1e-4, atol=1e-5)
+    result = hessian.apply(tf.constant(vectors[0]))
+    np.testing.assert_allclose(result.numpy(), expected[0], rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "base_class",
+    [
+        tf.keras.optimizers.RMSprop,
+        tf.keras.optimizers.Adagrad,
+        tf.keras.optimizers.AdamW,
+        tf.keras.optimizers.Lion,
+    ],
+)
+def test_with_mfac_preconditions_any_optimizer(base_class):
+    """The wrapped optimizer applies the preconditioned gradient with the base rule."""
+    rng = np.random.default_rng(0)
+    init = rng.normal(size=9).astype(np.float32)
+    wrapped_var, base_var = tf.Variable(init), tf.Variable(init)
+    wrapped = with_mfac(base_class(learning_rate=0.01), m=M, damp=DAMP)
+    base = base_class(learning_rate=0.01)
+    hessian = InverseHessianApproximator(M, DAMP)
+    for _ in range(M + 2):
+        grad = tf.constant(rng.normal(size=9).astype(np.float32))
+        wrapped.apply_gradients([(grad, wrapped_var)])
+        hessian.update(grad)
+        base.apply_gradients([(hessian.apply(grad), base_var)])
+    assert isinstance(wrapped, base_class)
+    np.testing.assert_allclose(wrapped_var.numpy(), base_var.numpy(), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("optimizer_class", [MFAC, Mfac])
+def test_mirrored_strategy_matches_single_device(optimizer_class):
+    """Replicas all-reduce the gradients once and precondition them identically."""
+    rng = np.random.default_rng(5)
+    init = rng.normal(size=7).astype(np.float32)
+    grads = rng.normal(size=(M + 2, 2, 7)).astype(np.float32)
+
+    var = tf.Variable(init)
+    optimizer = optimizer_class(m=M, damp=DAMP, warm_start=2)
+    for step in grads:
+        optimizer.apply_gradients([(tf.constant(step.sum(axis=0)), var)])
+
+    strategy = tf.distribute.MirroredStrategy(["/cpu:0", "/cpu:1"])
+    with strategy.scope():
+        mirrored_var = tf.Variable(init)
+        mirrored_optimizer = optimizer_class(m=M, damp=DAMP, warm_start=2)
+
+    @tf.function
+    def train_step(step):
+        def replica_fn():
+            replica = tf.distribute.get_replica_context().replica_id_in_sync_group
+            grad = tf.gather(step, replica)
+            mirrored_optimizer.apply_gradients([(grad, mirrored_var)])
+
+        strategy.run(replica_fn)
+
+    for step in grads:
+        train_step(tf.constant(step))
+    block = mirrored_optimizer.blocks[0]
+    assert block.hessian.GradFifo.shard_size == 4
+    np.testing.assert_allclose(mirrored_var.numpy(), var.numpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("optimizer_class", [MFAC, Mfac, Adam_Mfac])
+@pytest.mark.parametrize("in_function", [False, True])
+def test_accumulation_steps_average_micro_batches(optimizer_class, in_function):
+    """k accumulated micro-batches give the update of their mean gradient."""
+    rng = np.random.default_rng(6)
+    init = rng.normal(size=7).astype(np.float32)
+    grads = rng.normal(size=(M + 1, 3, 7)).astype(np.float32)
+
+    var = tf.Variable(init)
+    optimizer = optimizer_class(m=M, damp=DAMP, warm_start=2)
+    for step in grads:
+        optimizer.apply_gradients([(tf.constant(step.mean(axis=0)), var)])
+
+    accumulated_var = tf.Variable(init)
+    accumulating = optimizer_class(m=M, damp=DAMP, warm_start=2, accumulation_steps=3)
+    apply = accumulating.apply_gradients
+    if in_function:
+        apply = tf.function(apply)
+    for step in grads:
+        for micro_grad in step:
+            apply([(tf.constant(micro_grad), accumulated_var)])
+    assert int(accumulating.iterations) == M + 1
+    assert int(accumulating.blocks[0].hessian.GradFifo.counter) == M + 1
+    np.testing.assert_allclose(accumulated_var.numpy(), var.numpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+@pytest.mark.parametrize("optimizer_class", [MFAC, Adam_Mfac])
+def test_checkpoint_restores_history(tmp_path, optimizer_class, on_disk):
+    """A restored optimizer preconditions right away like the saved one."""
+    history_path = tmp_path / "history" if on_disk else None
+    rng = np.random.default_rng(7)
+    grads = rng.normal(size=(M + 3, 7)).astype(np.float32)
+    var = tf.Variable(tf.ones(7))
+    optimizer = optimizer_class(m=M, damp=DAMP, history_path=history_path)
+    for grad in grads[:M]:
+        optimizer.apply_gradients([(tf.constant(grad), var)])
+    path = tf.train.Checkpoint(optimizer=optimizer, var=var).save(str(tmp_path / "ckpt"))
+
+    restored_var = tf.Variable(tf.zeros(7))
+    config = optimizer.get_config()
+    restored = optimizer_class.from_config(config)
+    assert restored.get_config() == config
+    # restored when the variables are created in the first apply_gradients
+    tf.train.Checkpoint(optimizer=restored, var=restored_var).restore(path)
+    for grad in grads[M:]:
+        optimizer.apply_gradients([(tf.constant(grad), var)])
+        restored.apply_gradients([(tf.constant(grad), restored_var)])
+    np.testing.assert_allclose(restored_var.numpy(), var.numpy(), rtol=1e-5, atol=1e-6)
+    assert int(restored.blocks[0].hessian.GradFifo.counter) == M + 3
+
+
+@pytest.mark.parametrize("refresh_interval", [1, 3])
+def test_checkpoint_masks_rows_written_to_disk_after_save(tmp_path, refresh_interval):
+    """Rows the history file got after the checkpoint are not used after a restore."""
+    rng = np.random.default_rng(13)
+    grads = rng.normal(size=(M + 3, 7)).astype(np.float32)
+    vec = rng.normal(size=7).astype(np.float32)
+    var = tf.Variable(tf.ones(7))
+    kwargs = dict(m=M, damp=DAMP, refresh_interval=refresh_interval, history_path=tmp_path)
+    optimizer = MFAC(**kwargs)
+    for grad in grads[:M]:
+        optimizer.apply_gradients([(tf.constant(grad), var)])
+    path = tf.train.Checkpoint(optimizer=optimizer).save(str(tmp_path / "ckpt"))
+    # the file gets the rows of the next two steps, which the checkpoint does not know
+    for grad in grads[M : M + 2]:
+        optimizer.apply_gradients([(tf.constant(grad), var)])
+    restored = MFAC(**kwargs)
+    tf.train.Checkpoint(optimizer=restored).restore(path)
+    restored.apply_gradients([(tf.constant(grads[M + 2]), tf.Variable(tf.ones(7)))])
+    # slot 0 holds the new gradient, slot 1 lost the checkpointed one
+    history = np.stack([grads[M + 2], np.zeros(7), grads[2], grads[3]]).astype(np.float64)
+    expected = _dense_inverse_hessian_product(history, vec)
+    actual = restored.blocks[0].hessian.apply(tf.constant(vec)).numpy()
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("prebuilt", [False, True])
+@pytest.mark.parametrize("momentum, nesterov", [(0.0, False), (0.9, False), (0.9, True)])
+def test_sparse_gradients_skip_preconditioning(momentum, nesterov, prebuilt):
+    """Embedding gradients stay sparse and get the plain SGD update, also if built before."""
+    embedding = tf.keras.layers.Embedding(50, 3, embeddings_initializer="ones")
+    dense = tf.keras.layers.Dense(2, kernel_initializer="ones")
+    tokens = tf.constant([[1, 4], [4, 7]])
+    dense(embedding(tokens))
+    sgd_embeddings = tf.Variable(embedding.embeddings)
+    optimizer = MFAC(m=M, damp=DAMP, learning_rate=0.1, momentum=momentum, nesterov=nesterov)
+    sgd = tf.keras.optimizers.SGD(learning_rate=0.1, momentum=momentum, nesterov=nesterov)
+    if prebuilt:
+        # like compile_from_config after load_model
+        optimizer.build(embedding.trainable_variables + dense.trainable_variables)
+    for _ in range(M + 1):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_sum(dense(embedding(tokens)) ** 2)
+        variables = embedding.trainable_variables + dense.trainable_variables
+        grads = tape.gradient(loss, variables)
+        assert isinstance(grads[0], tf.IndexedSlices)
+        sgd.apply_gradients([(grads[0], sgd_embeddings)])
+        optimizer.apply_gradients(zip(grads, variables))
+        assert isinstance(optimizer.scale_grads(grads)[0], tf.IndexedSlices)
+    assert [block.m for block in optimizer.blocks] == [None, M]
+    assert optimizer.blocks[1].hessian.GradFifo.values.shape[1] == 3 * 2 + 2
+    np.testing.assert_allclose(embedding.embeddings.numpy(), sgd_embeddings.numpy(), rtol=1e-6)
+
+
+def test_set_history_size_under_mirrored_strategy():
+    """Every replica resizes its own shard of the history."""
+    strategy = tf.distribute.MirroredStrategy(["/cpu:0", "/cpu:1"])
+    with strategy.scope():
+        var = tf.Variable(tf.zeros(7))
+        optimizer = MFAC(m=M, damp=DAMP, resizable_history=True)
+    rng = np.random.default_rng(10)
+    for grad in rng.normal(size=(M + 1, 7)).astype(np.float32):
+        strategy.run(tf.function(lambda: optimizer.apply_gradients([(tf.constant(grad), var)])))
+    optimizer.set_history_size(2)
+    fifo = optimizer.blocks[0].hessian.GradFifo
+    for values, counter in zip(fifo.values.values, fifo.counter.values):
+        assert int(counter) == 2
+        assert np.all(values.numpy()[2:] == 0)
+        assert np.all(np.any(values.numpy()[:2] != 0, axis=1))
+
+
+@pytest.mark.parametrize("optimizer_class", [MFAC, Adam_Mfac])
+def test_profile_times_phases_without_changing_updates(tmp_path, optimizer_class):
+    """Profiled steps log their phases and give the same model as unprofiled ones."""
+    rng = np.random.default_rng(11)
+    x = rng.normal(size=(64, 5)).astype(np.float32)
+    y = rng.normal(size=(64, 1)).astype(np.float32)
+    weights = []
+    for profile in (False, True):
+        model = tf.keras.Sequential([tf.keras.layers.Dense(1, kernel_initializer="ones")])
+        model.compile(optimizer=optimizer_class(m=M, damp=DAMP, profile=profile), loss="mse")
+        profiler = StepTimeProfiler(tmp_path / "steps.npz")
+        model.fit(x, y, batch_size=8, epochs=2, shuffle=False, verbose=0, callbacks=[profiler])
+        weights.append(model.get_weights())
+    np.testing.assert_allclose(weights[1][0], weights[0][0], rtol=1e-5)
+    steps = np.load(tmp_path / "steps.npz")
+    assert len(steps["step"]) == 16
+    assert list(steps["epoch"]) == [0] * 8 + [1] * 8
+    for phase in PROFILED_PHASES:
+        assert np.all(steps[phase] >= 0)
+    assert np.all(steps["setup"][M:] > 0)
+
+
+def test_checkpoint_restores_every_replica_shard(tmp_path):
+    """Every replica gets back its own shard of the history from a checkpoint."""
+    strategy = tf.distribute.MirroredStrategy(["/cpu:0", "/cpu:1"])
+    rng = np.random.default_rng(12)
+    grads = rng.normal(size=(M + 3, 7)).astype(np.float32)
+
+    def train(optimizer, var, steps):
+        for grad in steps:
+            strategy.run(tf.function(lambda: optimizer.apply_gradients([(tf.constant(grad), var)])))
+
+    with strategy.scope():
+        var = tf.Variable(tf.ones(7))
+        optimizer = MFAC(m=M, damp=DAMP, history_dtype="int8")
+    train(optimizer, var, grads[:M])
+    path = tf.train.Checkpoint(optimizer=optimizer, var=var).save(str(tmp_path / "ckpt"))
+    with strategy.scope():
+        restored_var = tf.Variable(tf.zeros(7))
+        restored = MFAC.from_config(optimizer.get_config())
+        # restored when the variables are created in the first apply_gradients
+        tf.train.Checkpoint(optimizer=restored, var=restored_var).restore(path)
+    train(restored, restored_var, grads[M : M + 1])
+    train(optimizer, var, grads[M : M + 1])
+    saved, loaded = optimizer.blocks[0].hessian.GradFifo, restored.blocks[0].hessian.GradFifo
+    for name in ("values", "scales"):
+        for replica, (expected, actual) in enumerate(
+            zip(getattr(saved, name).values, getattr(loaded, name).values)
+        ):
+            np.testing.assert_array_equal(actual.numpy(), expected.numpy(), err_msg=f"{replica}")
+    train(optimizer, var, grads[M + 1 :])
+    train(restored, restored_var, grads[M + 1 :])
+    np.testing.assert_allclose(restored_var.numpy(), var.numpy(), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("slowdown, sizes", [(1.0, [512, 256, 128]), (0.3, [512, 1024])])
+def test_history_size_scheduler_follows_loss_trend(monkeypatch, slowdown, sizes):
+    """A flattening loss curve keeps halving, a drop below its trend undoes the halving."""
+    clock = itertools.count()
+    # every epoch takes one second of ten steps, whatever the history size
+    monkeypatch.setattr(time, "perf_counter", lambda: float(next(clock)))
+    resized = []
+    scheduler = HistorySizeScheduler(min_m=128)
+    scheduler.set_model(
+        SimpleNamespace(optimizer=SimpleNamespace(m=1024, set_history_size=resized.append))
+    )
+    scheduler.on_train_begin()
+    loss = 2.0
+    for epoch in range(10):
+        scheduler.on_epoch_begin(epoch)
+        for batch in range(10):
+            scheduler.on_train_batch_end(batch)
+        # the decrease shrinks geometrically, and by `slowdown` once the history shrank
+        loss -= 0.5 * 0.6**epoch * (slowdown if resized else 1.0)
+        scheduler.on_epoch_end(epoch, {"loss": loss})
+    assert resized == sizes
+    assert scheduler.settled
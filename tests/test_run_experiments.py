@@ -0,0 +1,52 @@
+"""Tests for :mod:`src.run_experiments`."""
+
+from omegaconf import OmegaConf
+
+from src.run_experiments import expand_jobs, job_logs, log_complete, pool_size, split_threads
+
+
+def test_expand_jobs_names_and_resume(tmp_path):
+    """Every combination gets its own log name and finished logs are detected."""
+    conf = OmegaConf.create(
+        {
+            "optimizer": {
+                "SGD": {"params": {"learning_rate": [0.1, 0.01]}, "batch_size": 32},
+                "MFAC": {"params": {"m": [8, 16], "damp": 1e-6}, "batch_size": 32},
+            },
+            "model": "resnet20",
+            "epochs": 2,
+            "runs": 2,
+        }
+    )
+    jobs = expand_jobs(conf)
+    assert len(jobs) == 8
+    assert len({(job["optimizer_name"], job["log_name"]) for job in jobs}) == 8
+    mfac_names = [job["log_name"] for job in jobs if job["optimizer_name"] == "MFAC"]
+    assert all("params-" not in name for name in mfac_names)
+    name = jobs[0]["log_name"]
+    log_file = tmp_path / f"2024-01-01:10:01m_{name}.csv"
+    log_file.write_text("epoch,time\n0,1.0\n")
+    assert not log_complete(tmp_path, name, conf.epochs)
+    # a resumed run logged epoch 0 again
+    log_file.write_text("epoch,time\n0,1.0\n0,1.0\n")
+    assert not log_complete(tmp_path, name, conf.epochs)
+    log_file.write_text("epoch,time\n0,1.0\n1,1.0\n")
+    assert log_complete(tmp_path, name, conf.epochs)
+    assert not log_complete(tmp_path, jobs[1]["log_name"], conf.epochs)
+
+
+def test_job_logs_and_thread_budget(tmp_path):
+    """Logs of a job are found oldest first and worker threads stay within budget."""
+    for stamp in ("2024-01-02:10:01m", "2024-01-01:10:01m"):
+        (tmp_path / f"{stamp}_resnet20_run-0.csv").write_text("epoch\n")
+    (tmp_path / "2024-01-01:10:01m_resnet20_run-1.csv").write_text("epoch\n")
+    assert [path.name[:10] for path in job_logs(tmp_path, "resnet20_run-0")] == [
+        "2024-01-01",
+        "2024-01-02",
+    ]
+    assert pool_size(4, 2) == (2, 1)
+    assert pool_size(3, 8) == (3, 2)
+    assert split_threads(1) == (1, 1)
+    for threads in range(2, 17):
+        intra, inter = split_threads(threads)
+        assert intra + inter == threads and 1 <= inter <= 2